@@ -1,39 +1,34 @@
 from __future__ import print_function
-import torch
-import torch.nn as nn
-import torch.nn.parallel
-import torch.backends.cudnn as cudnn
-import torch.optim as optim
-import torch.utils.data
-import torchvision.datasets as dset
-import torchvision.transforms as transforms
-import torchvision.utils as vutils
-from torch.autograd import Variable
-from collections import namedtuple
+from collections import namedtuple, deque
 import numpy as np
-import go_vncdriver
 import tensorflow as tf
 from model import LSTMPolicy
+from numpy_policy import NumpyPolicy
+from envs import VectorEnv
+from summaries import SummaryAggregator
+from pipeline_stats import PipelineStats
+from hogwild import SharedParams
 import six.moves.queue as queue
 import scipy.signal
 import threading
 import distutils.version
 import config
-import globalvar as GlobalVar
-import argparse
-import random
 import os
+import metrics
+import my_env
 import copy
-import wgan_models.dcgan as dcgan
-import wgan_models.mlp as mlp
-import support_lib
-import config
-import subprocess
 import time
-import multiprocessing
-import gan
 use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('0.12.0')
 
+# throughput of a worker, exported with the metrics of the other roles of the job
+env_steps = metrics.counter('env_steps_total', 'environment steps taken by the runner')
+rollouts_handed_off = metrics.counter('rollouts_handed_off_total', 'rollouts put on the runner queue')
+transitions_handed_off = metrics.counter('transitions_handed_off_total', 'steps in the rollouts put on the runner queue')
+imagined_rollouts = metrics.counter('imagined_rollouts_total', 'rollouts imagined by the gan put on the runner queue')
+handoff_latency = metrics.summary('handoff_latency_seconds', 'time rollouts wait on the runner queue')
+queue_depth = metrics.gauge('runner_queue_depth', 'rollouts on the runner queue')
+learner_updates = metrics.counter('learner_updates_total', 'updates of the learner')
+
 def discount(x, gamma):
     return scipy.signal.lfilter([1], [1, -gamma], x[::-1], axis=0)[::-1]
 
@@ -41,19 +36,25 @@ def process_rollout(rollout, gamma, lambda_=1.0):
     """
     given a rollout, compute its returns and the advantage
     """
-    batch_si = np.asarray(rollout.states)
-    batch_a = np.asarray(rollout.actions)
-    rewards = np.asarray(rollout.rewards)
-    vpred_t = np.asarray(rollout.values + [rollout.r])
-
-    rewards_plus_v = np.asarray(rollout.rewards + [rollout.r])
+    batch_si = rollout.states
+    batch_a = rollout.actions
+    rewards = rollout.rewards
+    n = len(rewards)
+
+    vpred_t = np.empty(n + 1)
+    vpred_t[:n] = rollout.values
+    vpred_t[n] = rollout.r
+
+    rewards_plus_v = np.empty(n + 1)
+    rewards_plus_v[:n] = rewards
+    rewards_plus_v[n] = rollout.r
     batch_r = discount(rewards_plus_v, gamma)[:-1]
     delta_t = rewards + gamma * vpred_t[1:] - vpred_t[:-1]
     # this formula for the advantage comes "Generalized Advantage Estimation":
     # https://arxiv.org/abs/1506.02438
     batch_adv = discount(delta_t, gamma * lambda_)
 
-    features = rollout.features[0]
+    features = rollout.initial_features()
     return Batch(batch_si, batch_a, batch_adv, batch_r, rollout.terminal, features)
 
 Batch = namedtuple("Batch", ["si", "a", "adv", "r", "terminal", "features"])
@@ -62,33 +63,88 @@ class PartialRollout(object):
     """
     a piece of a complete rollout.  We run our agent, and process its experience
     once it has processed enough steps.
+
+    Steps are written into numpy buffers of num_local_steps rows, allocated on the
+    first add once the shapes are known.  extend chains the segments of another
+    rollout instead of copying them; the arrays are only made contiguous when they
+    are read, which is a view when there is a single segment.
     """
-    def __init__(self):
-        self.states = []
-        self.actions = []
-        self.rewards = []
-        self.values = []
+    def __init__(self, num_local_steps=20, env_index=0):
+        self.capacity = num_local_steps
+        self.size = 0
+        self.buffers = None
+        self.segments = [self]
         self.r = 0.0
         self.terminal = False
-        self.features = []
+        self.env_index = env_index
+        self.queued_time = None
+
+    def __len__(self):
+        return sum(segment.size for segment in self.segments)
+
+    def allocate(self, state, action, features):
+        n = self.capacity
+        self.buffers = {
+            'states': np.empty((n,) + np.shape(state), np.float32),
+            'actions': np.empty((n,) + np.shape(action), np.float32),
+            'rewards': np.empty((n,)),
+            'values': np.empty((n,)),
+            'c': np.empty((n,) + np.shape(features[0]), np.float32),
+            'h': np.empty((n,) + np.shape(features[1]), np.float32),
+        }
 
     def add(self, state, action, reward, value, terminal, features):
-        self.states += [state]
-        self.actions += [action]
-        self.rewards += [reward]
-        self.values += [value]
+        segment = self.segments[-1]
+        if segment.size == segment.capacity:
+            '''full, chain a new segment'''
+            segment = PartialRollout(self.capacity, self.env_index)
+            self.segments.append(segment)
+        if segment.buffers is None:
+            segment.allocate(state, action, features)
+
+        i = segment.size
+        segment.buffers['states'][i] = state
+        segment.buffers['actions'][i] = action
+        segment.buffers['rewards'][i] = reward
+        segment.buffers['values'][i] = np.squeeze(value)
+        segment.buffers['c'][i] = features[0]
+        segment.buffers['h'][i] = features[1]
+        segment.size += 1
         self.terminal = terminal
-        self.features += [features]
 
     def extend(self, other):
         assert not self.terminal
-        self.states.extend(other.states)
-        self.actions.extend(other.actions)
-        self.rewards.extend(other.rewards)
-        self.values.extend(other.values)
+        assert self.env_index == other.env_index
+        self.segments.extend(other.segments)
         self.r = other.r
         self.terminal = other.terminal
-        self.features.extend(other.features)
+
+    def contiguous(self, key):
+        parts = [segment.buffers[key][:segment.size] for segment in self.segments if segment.size > 0]
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts, 0)
+
+    @property
+    def states(self):
+        return self.contiguous('states')
+
+    @property
+    def actions(self):
+        return self.contiguous('actions')
+
+    @property
+    def rewards(self):
+        return self.contiguous('rewards')
+
+    @property
+    def values(self):
+        return self.contiguous('values')
+
+    def initial_features(self):
+        '''the lstm state the rollout started from'''
+        segment = [segment for segment in self.segments if segment.size > 0][0]
+        return [segment.buffers['c'][0], segment.buffers['h'][0]]
 
 class RunnerThread(threading.Thread):
     """
@@ -96,22 +152,24 @@ class RunnerThread(threading.Thread):
     is that a universe environment is _real time_.  This means that there should be a thread
     that would constantly interact with the environment and tell it what to do.  This thread is here.
     """
-    def __init__(self, env, policy, num_local_steps, visualise, gan_runner):
+    def __init__(self, env, policy, num_local_steps, visualise, gan_runner, stats):
         threading.Thread.__init__(self)
         self.queue = queue.Queue(5)
+        self.stats = stats
         self.num_local_steps = num_local_steps
         self.env = env
         self.last_features = None
         self.policy = policy
         self.daemon = True
         self.sess = None
-        self.summary_writer = None
+        self.summaries = None
         self.visualise = visualise
         self.gan_runner = gan_runner
+        self.num_rollouts = 0
 
-    def start_runner(self, sess, summary_writer):
+    def start_runner(self, sess, summaries):
         self.sess = sess
-        self.summary_writer = summary_writer
+        self.summaries = summaries
         self.start()
 
     def run(self):
@@ -119,13 +177,24 @@ class RunnerThread(threading.Thread):
             self._run()
 
     def _run(self):
-        rollout_provider = env_runner(self.env, self.policy, self.num_local_steps, self.summary_writer, self.visualise, self.gan_runner)
+        if isinstance(self.env, VectorEnv):
+            rollout_provider = env_runner_batch(self.env, self.policy, self.num_local_steps, self.summaries, self.visualise, self.gan_runner, self.stats)
+        else:
+            rollout_provider = env_runner(self.env, self.policy, self.num_local_steps, self.summaries, self.visualise, self.gan_runner, self.stats)
         while True:
             # the timeout variable exists because apparently, if one worker dies, the other workers
             # won't die with it, unless the timeout is set to some large number.  This is an empirical
             # observation.
 
-            self.queue.put(next(rollout_provider), timeout=600.0)
+            rollout = next(rollout_provider)
+            self.stats.observe_queue(self.queue.qsize())
+            queue_depth.set(self.queue.qsize())
+            rollout.queued_time = time.time()
+            with self.stats.timer('queue_put'):
+                self.queue.put(rollout, timeout=600.0)
+            self.num_rollouts += 1
+            rollouts_handed_off.inc()
+            transitions_handed_off.inc(len(rollout))
 
 class GanRunnerThread(threading.Thread):
     """
@@ -133,59 +202,212 @@ class GanRunnerThread(threading.Thread):
     """
     def __init__(self):
         threading.Thread.__init__(self)
-        
-        '''create gan'''
-        self.gan = gan.gan()
+
+        '''
+        the worker only collects data for the gan process, so it does not
+        build the gan (and does not load torch) itself
+        '''
+        self.empty_dataset_with_aux = np.zeros((0, 5, config.gan_nc, config.gan_size, config.gan_size))
 
         '''dataset intialize'''
         self.reset_dateset()
 
-        '''bootstrap'''
-        np.savez(config.datadir+'data.npz',
-                 data=self.dataset)
+        '''
+        the dataset is saved by this thread and, on shutdown, by the main thread,
+        lock guards the buffer and save_lock the file
+        '''
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+        '''recent [llast, last, image] contexts, imagined rollouts start from them'''
+        if config.imagined_rollout_ratio > 0:
+            self.recent_contexts = deque(maxlen=4*config.imagined_batch_size)
+        else:
+            self.recent_contexts = None
+
+        '''bootstrap, but keep the transitions handed off before the last shutdown'''
+        if not os.path.exists(config.datadir+'data.npz'):
+            np.savez(config.datadir+'data.npz',
+                     data=self.dataset)
 
 
     def push_data(self, data):
-        self.dataset = np.concatenate((self.dataset,data),
-                                      axis=0)
+        with self.lock:
+            self.dataset = np.concatenate((self.dataset,data),
+                                          axis=0)
+        if self.recent_contexts is not None:
+            self.recent_contexts.extend(np.asarray(data[:,1:4], np.float32))
+
+    def sample_contexts(self, batch_size):
+        '''a batch of recent contexts, None until some data was collected'''
+        if self.recent_contexts is None or len(self.recent_contexts) == 0:
+            return None
+        recent = list(self.recent_contexts)
+        return np.asarray([recent[i] for i in np.random.randint(len(recent), size=batch_size)])
 
     def save_dataset(self):
+        '''
+        the collected data is swapped out under the lock, the file is read and
+        written outside of it, so push_data never waits for the disk
+        '''
+        with self.save_lock:
+            with self.lock:
+                dataset = self.dataset
+                self.reset_dateset()
+            if not self._save_dataset(dataset):
+                '''keep the data for the next try'''
+                with self.lock:
+                    self.dataset = np.concatenate((dataset, self.dataset), axis=0)
+
+    def _save_dataset(self, dataset):
 
         '''Try saving data'''
         try:
             previous_data = np.load(config.datadir+'data.npz')['data'] # load data
             print('Previous data found: '+str(np.shape(previous_data)))
-            self.push_data(previous_data)
+            dataset = np.concatenate((dataset, previous_data), axis=0)
 
             '''
             cat data to recent, this is only for similated env
             since the env is so fast
             '''
-            self.dataset=self.dataset[np.shape(self.dataset)[0]-config.gan_recent_dataset:np.shape(self.dataset)[0]]
+            dataset = dataset[max(np.shape(dataset)[0]-config.gan_recent_dataset, 0):]
 
-            print('Save data: '+str(np.shape(self.dataset)))
+            print('Save data: '+str(np.shape(dataset)))
             np.savez(config.datadir+'data.npz',
-                     data=self.dataset)
-            self.reset_dateset()
+                     data=dataset)
+            return True
         except Exception, e:
             print(str(Exception)+": "+str(e))
+            return False
 
     def reset_dateset(self):
-        self.dataset = self.gan.empty_dataset_with_aux
+        self.dataset = self.empty_dataset_with_aux
 
     def run(self):
 
         while True:
             self.save_dataset()
-            self.gan.load_models()
             time.sleep(config.gan_worker_com_internal)
 
+class ImaginationThread(threading.Thread):
+    """
+    Generates imagined rollouts for the learner.  Starting from real contexts
+    collected by the gan runner, the policy acts in a whole batch of contexts and
+    the generator of the gan predicts all next frames with one forward pass.
+    Imagined rollouts go to the queue of the runner, at most
+    config.imagined_rollout_ratio of them per real rollout, so the learner gets
+    more updates for each real environment step.
+
+    The gan does not predict rewards: on the grid they are read from the predicted
+    frame with my_env.observation_reward, elsewhere imagined rewards are 0.
+    """
+    def __init__(self, runner, gan_runner, policy, num_local_steps, num_threads=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.num_threads = num_threads
+        self.runner = runner
+        self.gan_runner = gan_runner
+        self.policy = policy
+        self.num_local_steps = num_local_steps
+        self.num_rollouts = 0
+        self.sess = None
+        self.gan = None
+        self.last_load_time = 0.0
+
+        '''imagined rollouts never chain with real ones, nor with each other'''
+        self.next_env_index = -1
+
+    def start_imagination(self, sess):
+        self.sess = sess
+        self.start()
+
+    def run(self):
+        # torch is only loaded by workers that imagine
+        import gan
+        if self.num_threads is not None:
+            '''the generator shares the cores of the worker, as its tensorflow session does'''
+            import torch
+            torch.set_num_threads(self.num_threads)
+        self.gan = gan.generator()
+        self.last_load_time = time.time()
+        with self.sess.as_default():
+            while True:
+                if time.time() - self.last_load_time > config.gan_worker_com_internal:
+                    '''pick up the models the gan process saved since'''
+                    self.gan.load_models()
+                    self.last_load_time = time.time()
+
+                '''imagine no more rollouts than the ratio allows, so real ones are not queued behind them'''
+                budget = int(config.imagined_rollout_ratio * self.runner.num_rollouts) - self.num_rollouts
+                if budget <= 0:
+                    time.sleep(0.1)
+                    continue
+
+                contexts = self.gan_runner.sample_contexts(min(config.imagined_batch_size, budget))
+                if contexts is None:
+                    time.sleep(1.0)
+                    continue
+
+                for rollout in self.imagine(contexts):
+                    rollout.queued_time = time.time()
+                    self.runner.queue.put(rollout, timeout=600.0)
+                    self.num_rollouts += 1
+                    imagined_rollouts.inc()
+
+    def imagine(self, contexts):
+        batch_size, _, nc, size, _ = contexts.shape
+        frames = contexts
+        states = np.asarray([rbg2gray(frame) for frame in frames[:,-1]])
+        c, h = [np.concatenate([f] * batch_size, 0) for f in self.policy.get_initial_features()]
+
+        rollouts = []
+        for _ in range(batch_size):
+            rollouts += [PartialRollout(self.num_local_steps, env_index=self.next_env_index)]
+            self.next_env_index -= 1
+        terminals = np.zeros(batch_size, bool)
+
+        for _ in range(self.num_local_steps):
+            actions, values_, c_next, h_next = self.policy.act_batch(states, c, h)
+
+            '''same action encoding as the aux of the gan dataset'''
+            aux = (1.0 * actions.argmax(1) / config.action_space).reshape(batch_size, 1, 1, 1)
+            prediction = self.gan.predict(frames.reshape(batch_size, 3*nc, size, size), aux)
+            prediction = np.clip(prediction, 0.0, 1.0)
+
+            for i in range(batch_size):
+                if terminals[i]:
+                    continue
+                if config.overwirite_with_grid:
+                    reward = my_env.observation_reward(prediction[i])
+                else:
+                    reward = 0.0
+                terminals[i] = reward > 0
+                rollouts[i].add(states[i], actions[i], reward, values_[i], terminals[i], [c[i:i+1], h[i:i+1]])
+
+            frames = np.concatenate([frames[:,1:], prediction[:,np.newaxis]], 1)
+            states = np.asarray([rbg2gray(frame) for frame in prediction])
+            c, h = c_next, h_next
+            if terminals.all():
+                break
+
+        '''bootstrap the rollouts that did not reach the target'''
+        values = self.policy.value_batch(states, c, h)
+        for i in range(batch_size):
+            if not terminals[i]:
+                rollouts[i].r = values[i]
+        return rollouts
+
 def rbg2gray(rgb):
     gray = rgb[0]*0.299 + rgb[1]*0.587 + rgb[2]*0.114  # Gray = R*0.299 + G*0.587 + B*0.114
     gray = np.expand_dims(gray,2)
     return gray
 
-def env_runner(env, policy, num_local_steps, summary_writer, render, gan_runner):
+def policy_ob_shape(ob_space):
+    '''the policy sees observations through rbg2gray'''
+    return rbg2gray(np.zeros(ob_space.shape)).shape
+
+def env_runner(env, policy, num_local_steps, summaries, render, gan_runner, stats):
     """
     The logic of the thread runner.  In brief, it constantly keeps on running
     the policy, and as long as the rollout exceeds a certain length, the thread
@@ -207,13 +429,14 @@ def env_runner(env, policy, num_local_steps, summary_writer, render, gan_runner)
 
     while True:
         terminal_end = False
-        rollout = PartialRollout()
+        rollout = PartialRollout(num_local_steps)
 
         for _ in range(num_local_steps):
 
             if config.agent_acting:
                 '''act from model'''
-                fetched = policy.act(last_state, *last_features)
+                with stats.timer('act'):
+                    fetched = policy.act(last_state, *last_features)
                 action, value_, features = fetched[0], fetched[1], fetched[2:]
             else:
                 '''genrate random action'''
@@ -225,11 +448,10 @@ def env_runner(env, policy, num_local_steps, summary_writer, render, gan_runner)
                 value_ = 0.0
                 features = np.zeros((2,1,256))
 
-            if config.overwirite_with_grid:
-                GlobalVar.set_mq_client(action.argmax())
-                
             # argmax to convert from one-hot
-            image, reward, terminal, info = env.step(action.argmax())
+            with stats.timer('env_step'):
+                image, reward, terminal, info = env.step(action.argmax())
+            env_steps.inc()
 
             if last_image is None or llast_image is None or lllast_image is None:
                 pass
@@ -260,13 +482,8 @@ def env_runner(env, policy, num_local_steps, summary_writer, render, gan_runner)
             last_state = state
             last_features = features
 
-            if info:
-                summary = tf.Summary()
-                for k, v in info.items():
-                    summary.value.add(tag=k, simple_value=float(v))
-                if config.agent_acting:
-                    summary_writer.add_summary(summary, policy.global_step.eval())
-                    summary_writer.flush()
+            if info and config.agent_acting:
+                summaries.add_scalars(info)
             
             if terminal:
                 terminal_end = True
@@ -290,8 +507,107 @@ def env_runner(env, policy, num_local_steps, summary_writer, render, gan_runner)
         # once we have enough experience, yield it, and have the ThreadRunner place it on a queue
         yield rollout
 
+def env_runner_batch(vector_env, policy, num_local_steps, summaries, render, gan_runner, stats):
+    """
+    Same as env_runner, but drives the environments of an envs.VectorEnv at once.
+    The environments are stepped concurrently and the policy acts in all of them
+    with one session call, while each environment keeps its own lstm state, image
+    recorder and rollout.  A rollout is yielded as soon as its own environment has
+    run num_local_steps steps or terminated, so rollouts of different environments
+    are never mixed.
+    """
+    num_envs = vector_env.num_envs
+
+    '''create image recorders, one [lllast, llast, last] per env'''
+    recorders = [[None, None, observation] for observation in vector_env.reset()]
+    last_states = [rbg2gray(recorder[2]) for recorder in recorders]
+    last_features = [policy.get_initial_features() for _ in range(num_envs)]
+    rollouts = [PartialRollout(num_local_steps, env_index=i) for i in range(num_envs)]
+    lengths = [0] * num_envs
+    rewards_sum = [0] * num_envs
+
+    while True:
+
+        if config.agent_acting:
+            '''act from model, in all envs at once'''
+            with stats.timer('act'):
+                fetched = policy.act_batch(np.asarray(last_states),
+                                           np.concatenate([f[0] for f in last_features], 0),
+                                           np.concatenate([f[1] for f in last_features], 0))
+            actions, values_ = fetched[0], fetched[1]
+            features = [[fetched[2][i:i+1], fetched[3][i:i+1]] for i in range(num_envs)]
+        else:
+            '''genrate random actions'''
+            actions = np.zeros((num_envs, config.action_space))
+            actions[np.arange(num_envs), np.random.randint(0, high=config.action_space-1, size=num_envs)] = 1.0
+            values_ = np.zeros((num_envs))
+            features = [np.zeros((2,1,256)) for _ in range(num_envs)]
+
+        # argmax to convert from one-hot
+        with stats.timer('env_step'):
+            images, rewards, terminals, infos = vector_env.step(actions.argmax(1))
+        env_steps.inc(num_envs)
+
+        if render:
+            vector_env.render()
+
+        gan_data = []
+        finished = []
+        for i in range(num_envs):
+            action = actions[i]
+            image, reward, terminal, info = images[i], rewards[i], terminals[i], infos[i]
+
+            lllast_image, llast_image, last_image = recorders[i]
+            if last_image is None or llast_image is None or lllast_image is None:
+                pass
+            else:
+                aux = np.zeros(np.shape(image))
+                aux[0:1,0:1,0:1] = (1.0*action.argmax()) / config.action_space
+                gan_data += [np.asarray([lllast_image,llast_image,last_image,image,aux])]
+            recorders[i] = [llast_image, last_image, copy.deepcopy(image)]
+
+            # collect the experience
+            rollouts[i].add(last_states[i], action, reward, values_[i], terminal, last_features[i])
+            lengths[i] += 1
+            rewards_sum[i] += reward
+
+            last_states[i] = rbg2gray(image)
+            last_features[i] = features[i]
+
+            if info and config.agent_acting:
+                summaries.add_scalars(info)
+
+            if terminal:
+                last_features[i] = policy.get_initial_features()
+                print("Episode finished in env %d. Sum of rewards: %d. Length: %d" % (i, rewards_sum[i], lengths[i]))
+                lengths[i] = 0
+                rewards_sum[i] = 0
+                '''reset image recorder'''
+                recorders[i] = [None, None, None]
+                finished += [i]
+            elif len(rollouts[i]) >= num_local_steps:
+                finished += [i]
+
+        if len(gan_data) > 0:
+            gan_runner.push_data(np.asarray(gan_data))
+
+        '''bootstrap the rollouts that were cut before the episode ended'''
+        bootstrap = [i for i in finished if not rollouts[i].terminal]
+        if len(bootstrap) > 0 and config.agent_acting:
+            values = policy.value_batch(np.asarray([last_states[i] for i in bootstrap]),
+                                        np.concatenate([last_features[i][0] for i in bootstrap], 0),
+                                        np.concatenate([last_features[i][1] for i in bootstrap], 0))
+            for i, value in zip(bootstrap, values):
+                rollouts[i].r = value
+
+        # once an env has enough experience, yield its rollout, and have the ThreadRunner place it on a queue
+        for i in finished:
+            yield rollouts[i]
+            rollouts[i] = PartialRollout(num_local_steps, env_index=i)
+
 class A3C(object):
-    def __init__(self, env, task, visualise):
+    def __init__(self, env, task, visualise, numpy_act=False, sync_every=1, max_staleness=None,
+                 backend='ps', shared_path=None, num_threads=None):
         """
         An implementation of the A3C algorithm that is reasonably well-tuned for the VNC environments.
         Below, we will have a modest amount of complexity due to the way TensorFlow handles data parallelism.
@@ -309,16 +625,22 @@ class A3C(object):
         ############################## A3C Model #############################
         ######################################################################
 
-        worker_device = "/job:worker/task:{}".format(task)
-        with tf.device(tf.train.replica_device_setter(1, worker_device=worker_device)):
+        if backend == 'hogwild':
+            # single node: the global network only keeps the last pulled copy of
+            # the shared parameters, for checkpoints, nothing lives on a ps task
+            worker_device = global_device = None
+        else:
+            worker_device = "/job:worker/task:{}".format(task)
+            global_device = tf.train.replica_device_setter(1, worker_device=worker_device)
+        with tf.device(global_device):
             with tf.variable_scope("global"):
-                self.network = LSTMPolicy(env.observation_space.shape, env.action_space.n)
+                self.network = LSTMPolicy(policy_ob_shape(env.observation_space), env.action_space.n)
                 self.global_step = tf.get_variable("global_step", [], tf.int32, initializer=tf.constant_initializer(0, dtype=tf.int32),
                                                    trainable=False)
 
         with tf.device(worker_device):
             with tf.variable_scope("local"):
-                self.local_network = pi = LSTMPolicy(env.observation_space.shape, env.action_space.n)
+                self.local_network = pi = LSTMPolicy(policy_ob_shape(env.observation_space), env.action_space.n)
                 pi.global_step = self.global_step
 
             self.ac = tf.placeholder(tf.float32, [None, env.action_space.n], name="ac")
@@ -346,7 +668,19 @@ class A3C(object):
             # on the one hand;  but on the other hand, we get less frequent parameter updates, which
             # slows down learning.  In this code, we found that making local steps be much
             # smaller than 20 makes the algorithm more difficult to tune and to get to work.
-            self.runner = RunnerThread(env, pi, 20, visualise, self.gan_runner)
+            # timings of acting, the runner queue and the learner
+            self.stats = PipelineStats(5)
+
+            # acting can run on a numpy mirror of the local network instead of a session call
+            self.numpy_policy = NumpyPolicy(pi) if numpy_act else None
+            self.runner = RunnerThread(env, self.numpy_policy or pi, 20, visualise, self.gan_runner, self.stats)
+
+            # extra rollouts imagined by the gan, from the same policy and into the same queue
+            if config.imagined_rollout_ratio > 0:
+                self.imagination = ImaginationThread(self.runner, self.gan_runner, self.numpy_policy or pi, 20,
+                                                     num_threads=num_threads)
+            else:
+                self.imagination = None
 
 
             grads = tf.gradients(self.loss, pi.var_list)
@@ -371,47 +705,186 @@ class A3C(object):
 
             grads, _ = tf.clip_by_global_norm(grads, 40.0)
 
-            # copy weights from the parameter server to the local model
-            self.sync = tf.group(*[v1.assign(v2) for v1, v2 in zip(pi.var_list, self.network.var_list)])
+            if backend == 'hogwild':
+                # parameters and optimizer statistics live in shared memory, the gradients
+                # are fetched and applied there by process(), and the weights are fed
+                # back to the global and the local model on every pull
+                self.shared = SharedParams(shared_path, [v.get_shape().as_list() for v in pi.var_list], task)
+                self.shared_in = [tf.placeholder(tf.float32, v.get_shape()) for v in pi.var_list]
+                self.shared_step_in = tf.placeholder(tf.int32, [])
+                self.sync = tf.group(*([v.assign(p) for v, p in zip(pi.var_list, self.shared_in)] +
+                                       [v.assign(p) for v, p in zip(self.network.var_list, self.shared_in)] +
+                                       [self.global_step.assign(self.shared_step_in)]))
+                self.inc_step = tf.no_op()
+                self.train_op = grads
+            else:
+                self.shared = None
+
+                # copy weights from the parameter server to the local model
+                self.sync = tf.group(*[v1.assign(v2) for v1, v2 in zip(pi.var_list, self.network.var_list)])
 
-            grads_and_vars = list(zip(grads, self.network.var_list))
-            self.inc_step = self.global_step.assign_add(tf.shape(pi.x)[0])
+                grads_and_vars = list(zip(grads, self.network.var_list))
+                self.inc_step = self.global_step.assign_add(tf.shape(pi.x)[0])
 
-            # each worker has a different set of adam optimizer parameters
-            opt = tf.train.AdamOptimizer(1e-4)
-            self.train_op = tf.group(opt.apply_gradients(grads_and_vars))
-            self.summary_writer = None
+                # each worker has a different set of adam optimizer parameters
+                opt = tf.train.AdamOptimizer(1e-4)
+                self.train_op = tf.group(opt.apply_gradients(grads_and_vars))
+            self.summaries = None
             self.local_steps = 0
+            self.held_rollout = None
+
+            # weights are pulled from the parameter server every sync_every updates, or earlier
+            # once the global step has moved more than max_staleness steps past the last pull
+            self.sync_every = sync_every
+            self.max_staleness = max_staleness
+            self.updates_since_sync = 0
+            self.synced_global_step = 0
+            self.last_global_step = 0
+
+            # parameter server traffic, every pull reads and every update writes the whole policy
+            self.param_bytes = sum(4 * np.prod(v.get_shape().as_list()) for v in self.network.var_list)
+            self.ps_bytes = 0
+            self.num_syncs = 0
+            self.perf_log_time = time.time()
+            self.perf_log_interval = 30.0
 
         ######################################################################
 
     def start(self, sess, summary_writer):
-        self.runner.start_runner(sess, summary_writer)
+        if self.numpy_policy is not None:
+            self.numpy_policy.load(sess)
+            '''the weights are mapped by name, make sure they act like the local network before acting with them'''
+            self.numpy_policy.check(sess)
+        # summaries are buffered and written from a background thread, off the acting and learning paths
+        self.summaries = SummaryAggregator(summary_writer, step_fn=lambda: self.last_global_step)
+        self.summaries.start()
+        self.runner.start_runner(sess, self.summaries)
         self.gan_runner.start()
-        self.summary_writer = summary_writer
-
-    def pull_batch_from_queue(self):
+        if self.imagination is not None:
+            self.imagination.start_imagination(sess)
+
+    def flush(self):
+        '''hand off the transitions collected since the last save, and write pending summaries'''
+        self.gan_runner.save_dataset()
+        if hasattr(self.env, 'flush'):
+            '''the last steps of a recorded environment'''
+            self.env.flush()
+        if self.summaries is not None:
+            self.summaries.write()
+
+    def pull_batch_from_queue(self, should_stop=None):
         """
         self explanatory:  take a rollout from the queue of the thread runner.
+        Returns None when should_stop() becomes true while waiting for it.
         """
-        rollout = self.runner.queue.get(timeout=600.0)
+        if self.held_rollout is not None:
+            rollout, self.held_rollout = self.held_rollout, None
+        else:
+            self.stats.observe_queue(self.runner.queue.qsize())
+            with self.stats.timer('queue_get'):
+                rollout = self.wait_for_rollout(should_stop)
+            if rollout is None:
+                return None
+            handoff_latency.observe(time.time() - rollout.queued_time)
         while not rollout.terminal:
             try:
-                rollout.extend(self.runner.queue.get_nowait())
+                other = self.runner.queue.get_nowait()
             except queue.Empty:
                 break
+            handoff_latency.observe(time.time() - other.queued_time)
+            if other.env_index != rollout.env_index:
+                '''rollouts of different envs can not be chained, keep it for the next update'''
+                self.held_rollout = other
+                break
+            rollout.extend(other)
         return rollout
 
-    def process(self, sess):
+    def wait_for_rollout(self, should_stop, timeout=600.0, poll=1.0):
+        '''the next rollout of the runner, checking should_stop every poll seconds'''
+        deadline = time.time() + timeout
+        while True:
+            if should_stop is not None and should_stop():
+                return None
+            try:
+                return self.runner.queue.get(timeout=min(poll, max(deadline - time.time(), 0.0)))
+            except queue.Empty:
+                if time.time() >= deadline:
+                    raise
+
+    def should_sync(self):
+        if self.updates_since_sync >= self.sync_every:
+            return True
+        if self.max_staleness is not None and self.last_global_step - self.synced_global_step > self.max_staleness:
+            return True
+        return False
+
+    def connect_shared(self, sess):
+        '''hogwild: the first worker publishes its initial weights, the others map them'''
+        if self.task == 0 and not os.path.exists(self.shared.path):
+            self.shared.create(sess.run(self.network.var_list), sess.run(self.global_step))
+        else:
+            self.shared.attach()
+
+    def pull_weights(self, sess):
+        if self.shared is not None:
+            feed_dict = dict(zip(self.shared_in, self.shared.params))
+            feed_dict[self.shared_step_in] = self.shared.global_step
+            sess.run(self.sync, feed_dict=feed_dict)
+        else:
+            sess.run(self.sync)  # copy weights from shared to local
+        if self.numpy_policy is not None:
+            self.numpy_policy.load(sess)
+        self.synced_global_step = self.last_global_step
+        self.updates_since_sync = 0
+        if self.shared is None:
+            self.ps_bytes += self.param_bytes
+        self.num_syncs += 1
+
+    def log_perf(self):
+        """
+        every perf_log_interval seconds, export parameter server traffic
+        and the pipeline timings as counters
+        """
+        now = time.time()
+        elapsed = now - self.perf_log_time
+        if elapsed < self.perf_log_interval:
+            return
+        if self.shared is None:
+            '''the hogwild backend has no parameter server, its syncs read shared memory'''
+            bytes_per_sec = self.ps_bytes / elapsed
+            print('[ps traffic] %.1f KB/s, %d syncs in %d updates' % (bytes_per_sec / 1024.0, self.num_syncs, self.local_steps))
+            self.summaries.add_scalar('perf/ps_bytes_per_sec', bytes_per_sec)
+        self.summaries.add_scalar('perf/syncs_per_update', float(self.num_syncs) / max(self.local_steps, 1))
+        self.ps_bytes = 0
+
+        scalars = self.stats.snapshot()
+        print('[pipeline] bound by %s: %s' % (PipelineStats.bottleneck(scalars),
+            ' '.join('%s=%.3g' % (k.split('/')[1], v) for k, v in sorted(scalars.items()))))
+        self.summaries.add_scalars(scalars)
+        self.perf_log_time = now
+
+    def process(self, sess, should_stop=None):
         """
         process grabs a rollout that's been produced by the thread runner,
         and updates the parameters.  The update is then sent to the parameter
-        server.
+        server.  Nothing is updated when should_stop() becomes true while
+        waiting for the rollout.
         """
 
-        sess.run(self.sync)  # copy weights from shared to local
-        rollout = self.pull_batch_from_queue()
+        # the pull runs while we wait for the runner's rollout
+        sync_thread = None
+        if self.should_sync():
+            sync_thread = threading.Thread(target=self.pull_weights, args=(sess,))
+            sync_thread.start()
+        rollout = self.pull_batch_from_queue(should_stop)
+        if rollout is None:
+            if sync_thread is not None:
+                sync_thread.join()
+            return
         batch = process_rollout(rollout, gamma=0.99, lambda_=1.0)
+        if sync_thread is not None:
+            with self.stats.timer('sync_wait'):
+                sync_thread.join()
 
         should_compute_summary = self.task == 0 and self.local_steps % 11 == 0
 
@@ -434,9 +907,22 @@ class A3C(object):
             self.local_network.state_in[1]: batch.features[1],
         }
 
-        fetched = sess.run(fetches, feed_dict=feed_dict)
+        with self.stats.timer('update'):
+            fetched = sess.run(fetches, feed_dict=feed_dict)
+            if config.agent_learning and self.shared is not None:
+                self.shared.apply_gradients(fetched[-1])
 
         if should_compute_summary:
-            self.summary_writer.add_summary(tf.Summary.FromString(fetched[0]), fetched[1])
-            self.summary_writer.flush()
+            self.summaries.add_summary(tf.Summary.FromString(fetched[0]), fetched[1])
+            self.last_global_step = fetched[1]
+        else:
+            self.last_global_step = fetched[0]
+        if self.shared is not None:
+            self.last_global_step = self.shared.add_steps(len(batch.si))
+        if config.agent_learning and self.shared is None:
+            self.ps_bytes += self.param_bytes
+        self.updates_since_sync += 1
         self.local_steps += 1
+        learner_updates.inc()
+        queue_depth.set(self.runner.queue.qsize())
+        self.log_perf()
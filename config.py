@@ -1,38 +1,54 @@
+import os
+import overrides
+
+# settings of a run can be overridden without editing this file, with
+# --set key=value on the command line or by sweep.py (see overrides.py)
+_overrides = overrides.load()
+
+def setting(name, default):
+    return _overrides.get(name, default)
+
 # exp time
-t = 5
-lable = 'sto_noise_action_half'
+t = setting('t', 5)
+lable = setting('lable', 'sto_noise_action_half')
 
 # mode
-run_on = 'agent' # agent, video
+run_on = setting('run_on', 'agent') # agent, video
 
-gan_size = 128
-gan_nc = 3
+gan_size = setting('gan_size', 128)
+gan_nc = setting('gan_nc', 3)
 
-if run_on is 'video':
-    dataset_path = '../../dataset/'
-    video_name_ = '3DPinball_1'
+if run_on == 'video':
+    dataset_path = setting('dataset_path', '../../dataset/')
+    video_name_ = setting('video_name_', '3DPinball_1')
     video_name = video_name_+'.mp4'
-    gan_predict_interval = 0.1
+    gan_predict_interval = setting('gan_predict_interval', 0.1)
     dataset_name_ = video_name_+'_d'+str(gan_predict_interval).replace('.','')+'_c'+str(gan_size)+'_nc'+str(gan_nc)
-    dataset_name = dataset_name_+'.npz'
-elif run_on is 'agent':
+    dataset_name = dataset_name_+'.npy'
+elif run_on == 'agent':
     dataset_name_ = 'agent'
 
 # gan model
-gan_batchsize = 64
-gan_nz = 256
-gan_ngpu = 2
-gan_dct = 4
-gan_gctc = 4
-gan_gctd = 4
+gan_batchsize = setting('gan_batchsize', 64)
+gan_nz = setting('gan_nz', 256)
+gan_ngpu = setting('gan_ngpu', 2)
+gan_dct = setting('gan_dct', 4)
+gan_gctc = setting('gan_gctc', 4)
+gan_gctd = setting('gan_gctd', 4)
 gan_model_name_ = 'bs'+str(gan_batchsize)+'_nz'+str(gan_nz)+'_dct'+str(gan_dct)+'_gctc'+str(gan_gctc)+'_gctd'+str(gan_gctd)
 
 # generate logdir according to config
 logdir = '../../result/gmbrl_1/'+dataset_name_+'/'+gan_model_name_+'_l'+lable+'_t'+str(t)+'/'
+
+# several experiments can run on one machine, each one in its own logdir,
+# train.py passes the name of the experiment to every process it starts
+experiment = os.environ.get('GMBRL_EXPERIMENT', '')
+if experiment:
+    logdir = logdir+experiment+'/'
 modeldir = logdir+gan_model_name_+'/'
 datadir = logdir+'data/'
 
-if run_on is 'agent':
+if run_on == 'agent':
     """
     config rl env here
     """ 
@@ -48,4 +64,26 @@ if run_on is 'agent':
     lower_gan_worker = 0.0
     lower_env_worker = 0.0
     agent_learning = False
-    agent_acting = False    
\ No newline at end of file
+    agent_acting = False
+
+    """
+    imagined rollouts, predicted by the gan from real 3-frame contexts,
+    are mixed into the learner's queue at this ratio to real rollouts
+    """
+    imagined_rollout_ratio = 0.0
+    imagined_batch_size = 16
+
+# the settings that can be overridden, the dirs and names derived from them can not
+_settable = ['t', 'lable', 'run_on', 'gan_size', 'gan_nc',
+             'dataset_path', 'video_name_', 'gan_predict_interval',
+             'gan_batchsize', 'gan_nz', 'gan_ngpu', 'gan_dct', 'gan_gctc', 'gan_gctd',
+             'overwirite_with_grid', 'action_space', 'grid_size', 'grid_target_x', 'grid_target_y',
+             'grid_action_random_discounter', 'gan_worker_com_internal', 'gan_save_image_internal',
+             'gan_recent_dataset', 'lower_gan_worker', 'lower_env_worker', 'agent_learning', 'agent_acting',
+             'imagined_rollout_ratio', 'imagined_batch_size']
+
+# the settings of the rl env are overridden here, the ones above went into the names of the dirs
+for _name, _value in _overrides.items():
+    if _name not in _settable or _name not in globals():
+        raise ValueError('Unknown config setting: ' + _name)
+    globals()[_name] = _value
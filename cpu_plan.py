@@ -0,0 +1,114 @@
+"""
+Core budget of the roles of a run on one machine.
+
+train.py plans which cores every role may use and passes them as --cpus to
+the role, which pins itself with apply() and sizes the thread pools of
+tensorflow, torch and numpy to the number of its cores, instead of every
+process assuming it has the whole machine.
+
+The gan trainer gets its own share of the cores, the workers split the rest
+evenly, and the ps task shares the cores of the workers with one thread.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+import multiprocessing
+import os
+import subprocess
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+def parse_cpus(text):
+    """'0-3,6' -> [0, 1, 2, 3, 6]"""
+    cpus = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += list(range(int(first), int(last) + 1))
+        elif part:
+            cpus += [int(part)]
+    return cpus
+
+def format_cpus(cpus):
+    """[0, 1, 2, 3, 6] -> '0-3,6'"""
+    parts = []
+    for cpu in sorted(cpus):
+        if parts and parts[-1][1] == cpu - 1:
+            parts[-1][1] = cpu
+        else:
+            parts.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in parts)
+
+def plan(names, cpus=None, gan_cpus=None):
+    """
+    map each role name (ps, w-N, gan) to the cores it may use,
+    roles that are not planned (such as tb) are not pinned
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    workers = [name for name in names if name.startswith('w-')]
+
+    budget = OrderedDict()
+    pool = list(cpus)
+    if 'gan' in names:
+        if gan_cpus is None:
+            gan_cpus = max(1, len(cpus) // 4)
+        gan_cpus = min(gan_cpus, len(cpus) - 1) if len(cpus) > 1 else 1
+        budget['gan'] = cpus[len(cpus) - gan_cpus:]
+        pool = cpus[:len(cpus) - gan_cpus] or cpus
+
+    if len(workers) > 0:
+        if len(workers) <= len(pool):
+            '''contiguous slices, the first workers get the remainder'''
+            share, extra = divmod(len(pool), len(workers))
+            start = 0
+            for i, name in enumerate(workers):
+                size = share + (1 if i < extra else 0)
+                budget[name] = pool[start:start + size]
+                start += size
+        else:
+            '''more workers than cores, one core each, round robin'''
+            for i, name in enumerate(workers):
+                budget[name] = [pool[i % len(pool)]]
+
+    if 'ps' in names:
+        budget['ps'] = pool
+    return budget
+
+def threads(name, cpus):
+    '''the ps task serves requests, one compute thread is enough'''
+    return 1 if name == 'ps' else len(cpus)
+
+def describe(budget):
+    return ['{}: cpus {} ({} threads)'.format(name, format_cpus(cpus), threads(name, cpus))
+            for name, cpus in budget.items()]
+
+def pin(cpus):
+    """
+    set the affinity of all threads of this process, python 2 has no
+    os.sched_setaffinity, taskset of util-linux does it there
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return
+    try:
+        subprocess.check_call(['taskset', '-a', '-p', '-c', format_cpus(cpus), str(os.getpid())],
+                              stdout=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('[cpu_plan] could not pin to cpus {}: {}'.format(format_cpus(cpus), e))
+
+def apply(cpus, num_threads=None):
+    """
+    pin this process to cpus, and limit the thread pools of the numeric
+    libraries, returns the number of threads the frameworks should use
+    """
+    if num_threads is None:
+        num_threads = len(cpus)
+    pin(cpus)
+
+    # read by openmp / mkl when torch or numpy create their pools
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
+    return num_threads
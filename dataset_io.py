@@ -0,0 +1,124 @@
+"""
+The offline datasets of run_gan_predict.py on disk: a raw .npy body, which
+is memory mapped rather than loaded, and a json header next to it (same
+name, .json) with its shape, dtype and the settings it was made with.
+
+The body holds every frame of the video once, [num_frames, nc, size, size].
+When the header has num_frames, only the first num_frames rows are valid.
+The samples are the windows of 4 consecutive frames, which are views of the
+frames (windows()), so a minibatch is a gather of the rows it needs
+(sample()), already in the [batch, 4*nc, size, size] layout of the gan.
+
+Opening a dataset only reads the two headers, whatever its size, and a
+minibatch only reads its frames from disk, so datasets may be larger than
+the memory of the machine.
+
+Datasets of 4-frame windows, in the former npz format or the .npy one, can
+be converted once with
+
+    python dataset_io.py <dataset>.npz
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import numpy as np
+
+LAYOUT = 'frames'
+WINDOW = 4
+
+def header_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+def create(path, shape, dtype=np.float32, **settings):
+    """a new dataset of zeros, memory mapped for writing, settings go into its header"""
+    header = dict(settings, shape=list(shape), dtype=np.dtype(dtype).name, layout=LAYOUT, window=WINDOW)
+    with open(header_path(path), 'w') as f:
+        json.dump(header, f, indent=2, sort_keys=True)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+def header(path):
+    with open(header_path(path)) as f:
+        return json.load(f)
+
+def set_num_frames(path, num_frames):
+    '''only the first num_frames of the body are valid, the others were never written'''
+    made_with = header(path)
+    made_with['num_frames'] = num_frames
+    with open(header_path(path), 'w') as f:
+        json.dump(made_with, f, indent=2, sort_keys=True)
+
+def open_dataset(path, **settings):
+    """
+    the valid frames of the dataset, memory mapped read only, raises
+    ValueError when settings differ from the ones it was made with
+    """
+    made_with = header(path)
+    if made_with.get('layout') != LAYOUT:
+        raise ValueError('{} holds 4-frame windows, convert it with python dataset_io.py {}'.format(path, path))
+    for name, value in settings.items():
+        if name in made_with and made_with[name] != value:
+            raise ValueError('{} was made with {}={}, not {}, rerun pre_dataset.py'.format(
+                path, name, made_with[name], value))
+    frames = np.load(path, mmap_mode='r')
+    if list(frames.shape) != made_with['shape']:
+        raise ValueError('{} has shape {}, its header says {}'.format(path, frames.shape, made_with['shape']))
+    return frames[:made_with.get('num_frames', len(frames))]
+
+def windows(frames, window=WINDOW):
+    """
+    [num_frames, ...] -> [num_frames - window + 1, window, ...], window i
+    being frames i to i + window - 1, as a view of frames
+    """
+    return np.lib.stride_tricks.as_strided(frames,
+                                           shape=(max(len(frames) - window + 1, 0), window) + frames.shape[1:],
+                                           strides=(frames.strides[0],) + frames.strides)
+
+def sample(frames, indexes, window=WINDOW):
+    """
+    the windows at indexes as [len(indexes), window * nc, size, size], the
+    frames of each window one after the other along the channels.  They
+    are read from disk in increasing order, so the windows come back sorted
+    """
+    batch = windows(frames, window)[np.sort(indexes)]
+    return np.ascontiguousarray(batch, dtype=np.float32).reshape((len(indexes), -1) + frames.shape[2:])
+
+def convert(path, out_path, **settings):
+    """a dataset of 4-frame windows (npz or .npy) -> the frames of the windows, once each"""
+    if path.endswith('.npz'):
+        '''an npz has to fit in memory once'''
+        old = np.load(path)['dataset']
+    else:
+        old = np.load(path, mmap_mode='r')
+    num_windows = len(old)
+    frames = create(out_path, (num_windows + WINDOW - 1,) + old.shape[2:], np.float32, **settings)
+    for first in range(0, num_windows, 1024):
+        end = min(first + 1024, num_windows)
+        frames[first:end] = old[first:end, 0]
+    if num_windows > 0:
+        frames[num_windows:] = old[-1, 1:]
+    frames.flush()
+    return frames
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a dataset of 4-frame windows into one of frames')
+    parser.add_argument('dataset', help='Dataset to convert, npz or .npy')
+    parser.add_argument('--out', default=None, help='Path of the new dataset, the same with .npy by default, '
+                                                    'a .npy dataset is replaced once converted')
+    args = parser.parse_args()
+    out_path = args.out or os.path.splitext(args.dataset)[0] + '.npy'
+    settings = {}
+    if os.path.exists(header_path(args.dataset)):
+        settings = dict((name, value) for name, value in header(args.dataset).items()
+                        if name not in ('shape', 'dtype', 'layout', 'window', 'num_frames'))
+    if os.path.abspath(out_path) == os.path.abspath(args.dataset):
+        tmp_path = out_path + '.converting.npy'
+        convert(args.dataset, tmp_path, **settings)
+        os.rename(tmp_path, out_path)
+        os.rename(header_path(tmp_path), header_path(out_path))
+    else:
+        convert(args.dataset, out_path, **settings)
+    print('{} -> {} {}'.format(args.dataset, out_path, header(out_path)['shape']))
+
+if __name__ == "__main__":
+    main()
@@ -10,18 +10,60 @@ from universe.wrappers import BlockingReset, GymCoreAction, EpisodeID, Unvectori
 from universe import spaces as vnc_spaces
 from universe.spaces.vnc_event import keycode
 import time
+import glob
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 import config
-import globalvar as GlobalVar
-import copy
 import my_env
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 universe.configure_logging()
 
-def create_env(env_id, client_id, remotes, **kwargs):
+def create_env(env_id, client_id, remotes, num_envs=1, record=None, replay_fps=None, **kwargs):
+    """
+    env_id 'replay:<path>' serves back the steps recorded in path (see ReplayEnv),
+    with record set the steps of the env are recorded to record/<client_id>
+    """
+    if num_envs > 1:
+        return VectorEnv([create_env(env_id, '{}-{}'.format(client_id, i), remote, record=record, replay_fps=replay_fps, **kwargs)
+                          for i, remote in enumerate(split_remotes(remotes, num_envs))])
+
+    if env_id.startswith('replay:'):
+        path = env_id[len('replay:'):]
+        if os.path.isdir(os.path.join(path, str(client_id))):
+            '''recorded per client, each client replays its own recording'''
+            path = os.path.join(path, str(client_id))
+        return ReplayEnv(path, fps=replay_fps)
+
+    env = create_recorded_env(env_id, client_id, remotes, **kwargs)
+    if record is not None:
+        env = RecordingEnv(env, os.path.join(record, str(client_id)))
+    return env
+
+def split_remotes(remotes, num_envs):
+    """
+    the remotes of each of num_envs environments: a count of local
+    remotes (such as '1') holds for each of them, addresses of vnc
+    servers are handed out one per environment
+    """
+    if remotes is None or remotes.isdigit():
+        return [remotes] * num_envs
+    remotes = remotes.split(',')
+    if len(remotes) != num_envs:
+        raise ValueError('{} environments need {} remotes, got {}: {}'.format(num_envs, num_envs, len(remotes), ','.join(remotes)))
+    return remotes
+
+def create_recorded_env(env_id, client_id, remotes, **kwargs):
+    if config.overwirite_with_grid:
+        env_id = my_env.GRID_ENV_ID
+
     spec = gym.spec(env_id)
 
-    if spec.tags.get('flashgames', False):
+    if spec.tags.get('grid', False):
+        return create_grid_env(env_id)
+    elif spec.tags.get('flashgames', False):
         return create_flash_env(env_id, client_id, remotes, **kwargs)
     elif spec.tags.get('atari', False) and spec.tags.get('vnc', False):
         return create_vncatari_env(env_id, client_id, remotes, **kwargs)
@@ -39,8 +81,7 @@ def create_flash_env(env_id, client_id, remotes, **_):
     reg = universe.runtime_spec('flashgames').server_registry
     height = reg[env_id]["height"]
     width = reg[env_id]["width"]
-    env = CropScreen(env, height, width, 84, 18)
-    env = FlashRescale(env)
+    env = FlashRescale(env, crop=(84, 18, height, width))
 
     keys = ['left', 'right', 'up', 'down', 'x']
     if env_id == 'flashgames.NeonRace-v0':
@@ -80,10 +121,176 @@ def create_atari_env(env_id):
     env = AtariRescale42x42(env)
     env = DiagnosticsInfo(env)
     env = Unvectorize(env)
-    if config.overwirite_with_grid:
-        env.action_space.n = 4
     return env
 
+def create_grid_env(env_id):
+    env = gym.make(env_id)
+    env = Vectorize(env)
+    env = DiagnosticsInfo(env)
+    env = Unvectorize(env)
+    return env
+
+class VectorEnv(object):
+    """
+    Several environments that are stepped concurrently by a thread pool, so that
+    the network and decode latency of VNC and flash environments overlaps instead
+    of adding up.  reset and step take and return lists with one entry per env.
+    """
+    def __init__(self, envs, num_threads=None):
+        self.envs = envs
+        self.num_envs = len(envs)
+        self.observation_space = envs[0].observation_space
+        self.action_space = envs[0].action_space
+        self.pool = ThreadPool(num_threads or self.num_envs)
+
+    def reset(self):
+        return self.pool.map(lambda env: env.reset(), self.envs)
+
+    def step(self, actions):
+        results = self.pool.map(lambda env_action: env_action[0].step(env_action[1]), list(zip(self.envs, actions)))
+        observations, rewards, dones, infos = [list(x) for x in zip(*results)]
+        return observations, rewards, dones, infos
+
+    def render(self, index=0):
+        return self.envs[index].render()
+
+    def flush(self):
+        for env in self.envs:
+            if hasattr(env, 'flush'):
+                env.flush()
+
+class RecordingEnv(object):
+    """
+    Wraps an environment and records what it returns to path: the observation
+    of every reset and step, its reward and whether it ended an episode.
+
+    Steps are buffered and written every chunk_size steps as one compressed
+    npz chunk, next to a meta.json describing the spaces, so that a ReplayEnv
+    can serve them back without the emulator.  Call flush() to write the last
+    partial chunk.  Actions and infos are not recorded.
+    """
+    def __init__(self, env, path, chunk_size=1000):
+        self.env = env
+        self.path = path
+        self.chunk_size = chunk_size
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        self.num_chunks = 0
+        self.lock = threading.Lock()
+        self.clear()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'shape': list(self.observation_space.shape),
+                       'low': float(np.min(self.observation_space.low)),
+                       'high': float(np.max(self.observation_space.high)),
+                       'actions': self.action_space.n}, f)
+
+    def clear(self):
+        self.observations, self.rewards, self.dones, self.resets = [], [], [], []
+
+    def record(self, observation, reward, done, reset):
+        with self.lock:
+            '''the preprocessed observations are views into a ring of frames, which is overwritten'''
+            self.observations.append(np.array(observation, copy=True))
+            self.rewards.append(reward)
+            self.dones.append(done)
+            self.resets.append(reset)
+            full = len(self.observations) >= self.chunk_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''also called on shutdown, from another thread than the one stepping'''
+        with self.lock:
+            if len(self.observations) == 0:
+                return
+            observations, rewards, dones, resets = self.observations, self.rewards, self.dones, self.resets
+            chunk_path = os.path.join(self.path, 'chunk_%05d.npz' % self.num_chunks)
+            self.num_chunks += 1
+            self.clear()
+        np.savez_compressed(chunk_path,
+                            observations=np.asarray(observations),
+                            rewards=np.asarray(rewards, np.float32),
+                            dones=np.asarray(dones, np.bool_),
+                            resets=np.asarray(resets, np.bool_))
+
+    def reset(self):
+        observation = self.env.reset()
+        self.record(observation, 0.0, False, True)
+        return observation
+
+    def step(self, action):
+        observation, reward, done, info = self.env.step(action)
+        self.record(observation, reward, done, False)
+        return observation, reward, done, info
+
+    def render(self):
+        return self.env.render()
+
+class ReplayEnv(object):
+    """
+    Serves the steps recorded by a RecordingEnv back, whatever the actions, in
+    the order they were recorded and from the beginning again once they run
+    out.  With fps, steps are paced at that fixed rate, otherwise they come as
+    fast as they are asked for.  Like the recorded envs, it resets itself: the
+    step that ends an episode returns the first observation of the next one.
+    """
+    def __init__(self, path, fps=None):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.observation_space = Box(meta['low'], meta['high'], meta['shape'])
+        self.action_space = spaces.Discrete(meta['actions'])
+
+        chunks = [np.load(chunk_path) for chunk_path in sorted(glob.glob(os.path.join(path, 'chunk_*.npz')))]
+        assert len(chunks) > 0, 'Nothing recorded in ' + path
+        self.observations = np.concatenate([chunk['observations'] for chunk in chunks], 0)
+        self.rewards = np.concatenate([chunk['rewards'] for chunk in chunks], 0)
+        self.dones = np.concatenate([chunk['dones'] for chunk in chunks], 0)
+        self.resets = np.concatenate([chunk['resets'] for chunk in chunks], 0)
+        logger.info('Replaying %d steps from %s', len(self.observations), path)
+
+        self.position = 0
+        self.interval = 1.0 / fps if fps else None
+        self.next_time = None
+
+    def wait(self):
+        if self.interval is None:
+            return
+        now = time.time()
+        if self.next_time is None or self.next_time < now - self.interval:
+            '''fell behind, do not try to catch up with a burst'''
+            self.next_time = now
+        elif self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time += self.interval
+
+    def advance(self):
+        self.position = (self.position + 1) % len(self.observations)
+
+    def reset(self):
+        '''the first observation of the next recorded episode'''
+        for _ in range(len(self.observations)):
+            if self.resets[self.position]:
+                break
+            self.advance()
+        observation = self.observations[self.position]
+        self.advance()
+        return observation
+
+    def step(self, action):
+        self.wait()
+        if self.resets[self.position]:
+            '''the recording was reset explicitly here, the replay resets itself'''
+            self.advance()
+        i = self.position
+        self.advance()
+        return self.observations[i], float(self.rewards[i]), bool(self.dones[i]), {}
+
+    def render(self):
+        pass
+
 def DiagnosticsInfo(env, *args, **kwargs):
     return vectorized.VectorizeFilter(env, DiagnosticsInfoI, *args, **kwargs)
 
@@ -101,32 +308,14 @@ class DiagnosticsInfoI(vectorized.Filter):
         self._num_vnc_updates = 0
         self._last_episode_id = -1
 
-        '''overwirte with grid'''
-        if config.overwirite_with_grid:
-            print('overwirite_with_grid')
-            self.env = my_env.env()
-
     def _after_reset(self, observation):
         logger.info('Resetting environment from open ai')
         self._episode_reward = 0
         self._episode_length = 0
         self._all_rewards = []
-
-        '''overwirte with grid'''
-        if config.overwirite_with_grid:
-            observation = self.env.get_initial_observation()
-
         return observation
 
     def _after_step(self, observation, reward, done, info):
-
-        '''overwirte with grid'''
-        if config.overwirite_with_grid:
-            
-            action = copy.deepcopy(int(GlobalVar.get_mq_client()))
-
-            observation, reward, done = self.env.act(action)
-
         to_log = {}
 
         if reward is not None:
@@ -148,25 +337,67 @@ class DiagnosticsInfoI(vectorized.Filter):
 
         return observation, reward, done, to_log
 
-def _process_frame42(frame):
-    frame = frame[34:34+160, :160]
-    # Resize by half, then down to 42x42 (essentially mipmapping). If
-    # we resize directly we lose pixels that, when mapped to 42x42,
-    # aren't close enough to the pixel boundary.
-    frame = cv2.resize(frame, (config.gan_size, config.gan_size))
-    frame = frame.mean(2)
-    frame = frame.astype(np.float32)
-    frame *= (1.0 / 255.0)
-    frame = np.reshape(frame, [config.gan_size, config.gan_size, 1])
-    return frame
+class FramePreprocessor(object):
+    """
+    Crops, resizes and converts to gray a whole batch of rgb frames, writing into
+    preallocated output buffers instead of allocating several arrays per frame.
+
+    The output is float32 scaled to [0, 1], or, with dtype=np.uint8, the raw gray
+    level.  Outputs are views into a ring of num_buffers buffers, so an observation
+    stays valid for num_buffers calls; keep a copy to hold on to it for longer.
+    """
+    def __init__(self, height, width, crop=None, dtype=np.float32, num_buffers=4):
+        self.height = height
+        self.width = width
+        self.crop = crop # (top, left, height, width)
+        self.dtype = dtype
+        self.num_buffers = num_buffers
+        self.buffers = []
+        self.buffer_i = 0
+        self.resized = None
+        self.gray_sum = np.empty((height, width), np.uint16)
+
+    def next_buffer(self, n):
+        if len(self.buffers) == 0 or self.buffers[0].shape[0] != n:
+            self.buffers = [np.empty((n, self.height, self.width, 1), self.dtype) for _ in range(self.num_buffers)]
+        self.buffer_i = (self.buffer_i + 1) % self.num_buffers
+        return self.buffers[self.buffer_i]
+
+    def __call__(self, frames):
+        out = self.next_buffer(len(frames))
+        observations = []
+        for i, frame in enumerate(frames):
+            if frame is None:
+                observations.append(None)
+                continue
+            if self.crop is not None:
+                top, left, height, width = self.crop
+                frame = frame[top:top+height, left:left+width]
+            if self.resized is None or self.resized.dtype != frame.dtype:
+                self.resized = np.empty((self.height, self.width, 3), frame.dtype)
+            cv2.resize(frame, (self.width, self.height), dst=self.resized)
+
+            # gray is the plain mean of the channels
+            gray = out[i, :, :, 0]
+            if self.dtype == np.uint8:
+                np.sum(self.resized, axis=2, dtype=np.uint16, out=self.gray_sum)
+                np.floor_divide(self.gray_sum, 3, out=gray, casting='unsafe')
+            else:
+                np.sum(self.resized, axis=2, dtype=np.float32, out=gray)
+                gray *= (1.0 / (3 * 255.0))
+            observations.append(out[i])
+        return observations
 
 class AtariRescale42x42(vectorized.ObservationWrapper):
-    def __init__(self, env=None):
+    def __init__(self, env=None, dtype=np.float32):
         super(AtariRescale42x42, self).__init__(env)
-        self.observation_space = Box(0.0, 1.0, [config.gan_size, config.gan_size, 1])
+        high = 255 if dtype == np.uint8 else 1.0
+        self.observation_space = Box(0.0, high, [config.gan_size, config.gan_size, 1])
+        # crop the playing area, then resize straight to gan_size
+        self.preprocess = FramePreprocessor(config.gan_size, config.gan_size, crop=(34, 0, 160, 160), dtype=dtype)
 
     def _observation(self, observation_n):
-        return [_process_frame42(observation) for observation in observation_n]
+        return self.preprocess(observation_n)
 
 class FixedKeyState(object):
     def __init__(self, keys):
@@ -243,17 +474,16 @@ class CropScreen(vectorized.ObservationWrapper):
         return [ob[self.top:self.top+self.height, self.left:self.left+self.width, :] if ob is not None else None
                 for ob in observation_n]
 
-def _process_frame_flash(frame):
-    frame = cv2.resize(frame, (200, 128))
-    frame = frame.mean(2).astype(np.float32)
-    frame *= (1.0 / 255.0)
-    frame = np.reshape(frame, [128, 200, 1])
-    return frame
-
 class FlashRescale(vectorized.ObservationWrapper):
-    def __init__(self, env=None):
+    """
+    Resizes flash frames to 128x200 gray. With crop=(top, left, height, width)
+    it also does the work of CropScreen in the same pass.
+    """
+    def __init__(self, env=None, crop=None, dtype=np.float32):
         super(FlashRescale, self).__init__(env)
-        self.observation_space = Box(0.0, 1.0, [128, 200, 1])
+        high = 255 if dtype == np.uint8 else 1.0
+        self.observation_space = Box(0.0, high, [128, 200, 1])
+        self.preprocess = FramePreprocessor(128, 200, crop=crop, dtype=dtype)
 
     def _observation(self, observation_n):
-        return [_process_frame_flash(observation) for observation in observation_n]
+        return self.preprocess(observation_n)
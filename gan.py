@@ -1,37 +1,18 @@
 from __future__ import print_function
 import torch
-import torch.nn as nn
-import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
-import torch.utils.data
-import torchvision.datasets as dset
-import torchvision.transforms as transforms
-import torchvision.utils as vutils
 from torch.autograd import Variable
-from collections import namedtuple
 import numpy as np
-import go_vncdriver
-import tensorflow as tf
-from model import LSTMPolicy
-import six.moves.queue as queue
-import scipy.signal
-import threading
-import distutils.version
 import config
-import globalvar as GlobalVar
-import argparse
 import random
-import os
-import copy
-import wgan_models.dcgan as dcgan
-import wgan_models.mlp as mlp
-import support_lib
-import config
-import subprocess
 import time
-import multiprocessing
-use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('0.12.0')
+import wgan_models.dcgan as dcgan
+import sample_writer
+import metrics
+
+iterations = metrics.counter('gan_iterations_total', 'generator iterations of the gan')
+dataset_size = metrics.gauge('gan_dataset_size', 'frames the gan is trained on')
 
 class gan():
     """
@@ -131,6 +112,13 @@ class gan():
         self.last_save_model_time = 0
         self.last_save_image = 0
 
+        '''write sample images off the training loop'''
+        self.sample_writer = sample_writer.SampleWriter()
+        self.sample_writer.start()
+
+        metrics.gauge('gan_checkpoint_age_seconds', 'seconds since the gan models were saved').set_function(
+            lambda: time.time() - self.last_save_model_time if self.last_save_model_time > 0 else float('nan'))
+
     def train(self):
         """
         train one iteraction
@@ -334,6 +322,7 @@ class gan():
                 self.last_save_image = time.time()
 
             self.iteration_i += 1
+            iterations.inc()
             ######################################################################
             ######################### End One in Iteration  ######################
             ######################################################################
@@ -375,6 +364,15 @@ class gan():
                                                                  start=self.dataset_aux.size()[0] - self.dataset_limit,
                                                                  length=self.dataset_limit)
 
+        dataset_size.set(self.dataset_image.size()[0])
+
+    def predict(self, state, action):
+        """
+        predict the next frame for a batch of states and actions, both numpy,
+        state is [batch, 3*nc, size, size], action is [batch, 1, 1, 1]
+        """
+        return predict_next(self.netG_Cv, self.netG_DeCv, self.nz, self.cuda, state, action)
+
     def load_models(self):
         '''do auto checkpoint'''
         try:
@@ -393,6 +391,26 @@ class gan():
         except Exception, e:
             print('Previous checkpoint for netD unfounded')
 
+    def save_dataset(self):
+        '''keep the transitions the gan is trained on, for a restart'''
+        np.savez(config.datadir+'gan_dataset.npz',
+                 image=self.dataset_image.cpu().numpy(),
+                 aux=self.dataset_aux.cpu().numpy())
+        print('Save gan dataset: '+str(self.dataset_image.size()[0]))
+
+    def load_dataset(self):
+        try:
+            saved = np.load(config.datadir+'gan_dataset.npz')
+            self.dataset_image = torch.FloatTensor(saved['image'])
+            self.dataset_aux = torch.FloatTensor(saved['aux'])
+            if self.cuda:
+                self.dataset_image = self.dataset_image.cuda()
+                self.dataset_aux = self.dataset_aux.cuda()
+            dataset_size.set(self.dataset_image.size()[0])
+            print('Previous gan dataset founded: '+str(self.dataset_image.size()[0]))
+        except Exception as e:
+            print('Previous gan dataset unfounded')
+
     def save_models(self):
         '''do checkpointing'''
         torch.save(self.netG_Cv.state_dict(), '{0}/{1}/netG_Cv.pth'.format(self.experiment,config.gan_model_name_))
@@ -401,20 +419,54 @@ class gan():
 
     def save_sample(self,sample,name):
 
-        '''function need for log image'''
-        def sample2image(sample):
-            if config.gan_nc is 1:
-                c = sample / 3.0
-                c = torch.unsqueeze(c,1)
-                save = torch.cat([c,c,c],1)
-            elif config.gan_nc is 3:
-                save = []
-                for image_i in range(4):
-                    save += [torch.unsqueeze(sample.narrow(0,image_i*3,3),0)]
-                save = torch.cat(save,0)
-            
-            # save = save.mul(0.5).add(0.5)
-            return save
-
-        '''log real result'''
-        vutils.save_image(sample2image(sample), ('{0}/'+name+'_{1}.png').format(self.experiment, self.iteration_i))
\ No newline at end of file
+        '''log real result, png encoding and writing happen on the sample writer thread'''
+        self.sample_writer.submit(sample, ('{0}/'+name+'_{1}.png').format(self.experiment, self.iteration_i))
+
+def predict_next(netG_Cv, netG_DeCv, nz, cuda, state, action):
+    '''the generator part of gan.predict, shared with the generator of the workers'''
+    state = torch.FloatTensor(state)
+    action = torch.FloatTensor(action)
+    noise = torch.FloatTensor(state.size()[0], nz/2, 1, 1).normal_(0, 1)
+    if cuda:
+        state, action, noise = state.cuda(), action.cuda(), noise.cuda()
+
+    # same as the fake path of train(), with netG totally frozen
+    encodedv = netG_Cv(Variable(state, volatile = True))
+    concated = [Variable(action, volatile = True)] * (nz/2)
+    concated += [encodedv]
+    concated += [Variable(noise, volatile = True)]
+    prediction = netG_DeCv(torch.cat(concated,1))
+    return prediction.data.cpu().numpy()
+
+class generator():
+    """
+    The generator of the gan alone, for inference in the workers: no critic,
+    optimizers, dataset or sample writer.  It runs on the gpus of the worker
+    when it has any and on the cpu otherwise, whatever config.gan_ngpu says.
+    """
+    def __init__(self):
+        self.nz = config.gan_nz
+        self.cuda = torch.cuda.is_available()
+        ngpu = min(config.gan_ngpu, torch.cuda.device_count()) if self.cuda else 1
+        self.netG_Cv = dcgan.DCGAN_G_Cv(config.gan_size, self.nz, config.gan_nc, 64, ngpu, 0)
+        self.netG_DeCv = dcgan.DCGAN_G_DeCv(config.gan_size, self.nz, config.gan_nc, 64, ngpu, 0)
+        if self.cuda:
+            self.netG_Cv.cuda()
+            self.netG_DeCv.cuda()
+        self.load_models()
+
+    def load_models(self):
+        '''the generator the gan process saved last, mapped onto the device of this worker'''
+        if self.cuda:
+            map_location = None
+        else:
+            map_location = lambda storage, location: storage
+        for name, net in [('netG_Cv', self.netG_Cv), ('netG_DeCv', self.netG_DeCv)]:
+            try:
+                net.load_state_dict(torch.load(config.modeldir+name+'.pth', map_location=map_location))
+            except Exception as e:
+                print('Previous checkpoint for '+name+' unfounded')
+
+    def predict(self, state, action):
+        """same as gan.predict"""
+        return predict_next(self.netG_Cv, self.netG_DeCv, self.nz, self.cuda, state, action)
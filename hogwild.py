@@ -0,0 +1,100 @@
+import numpy as np
+import os
+import time
+
+'''the global step is kept as one counter per worker, so at most this many workers'''
+MAX_WORKERS = 256
+
+def default_path(log_dir):
+    '''one parameter file per run, in shared memory when the system has it'''
+    name = 'a3c-' + os.path.abspath(log_dir).strip('/').replace('/', '-') + '.params'
+    root = '/dev/shm' if os.path.isdir('/dev/shm') else log_dir
+    return os.path.join(root, name)
+
+class SharedParams(object):
+    """
+    Parameters of a single-node run, shared by the worker processes through one
+    memory-mapped file instead of a parameter server.
+
+    The file holds the global step, the policy parameters and the RMSProp
+    statistics, all shared.  Workers read the parameters and apply their
+    gradients in place without any locking (Hogwild, as in the A3C paper), so
+    an update costs a few numpy ops on memory every process maps, instead of a
+    round trip to the ps task.
+
+    The global step can not be updated that way, increments of concurrent
+    workers would get lost.  It is the step the file was created at plus one
+    counter per worker, each written only by its own worker (task), summed
+    when read.
+    """
+    def __init__(self, path, shapes, task=0, lr=1e-4, decay=0.99, epsilon=0.1):
+        assert 0 <= task < MAX_WORKERS, 'the hogwild backend supports at most {} workers'.format(MAX_WORKERS)
+        self.path = path
+        self.task = task
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.num_params = sum(self.sizes)
+        self.lr = lr
+        self.decay = decay
+        self.epsilon = epsilon
+        self.header = None
+        self.params = None
+        self.ms = None
+
+    def create(self, values, global_step=0):
+        """
+        initialize the file from the values of one worker, and publish it
+        under path only once it is complete
+        """
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        self.map(tmp_path, create=True)
+        for param, value in zip(self.params, values):
+            param[...] = value
+        for ms in self.ms:
+            ms[...] = 0.0
+        self.header[0] = global_step
+        self.header[1:] = 0
+        self.header.flush()
+        os.rename(tmp_path, self.path)
+
+    def attach(self, timeout=600.0):
+        '''map the file once the creating worker published it'''
+        deadline = time.time() + timeout
+        while not os.path.exists(self.path):
+            if time.time() > deadline:
+                raise RuntimeError('Shared parameters never appeared at ' + self.path)
+            time.sleep(0.5)
+        self.map(self.path)
+
+    def map(self, path, create=False):
+        n = self.num_params
+        header_size = 8 * (1 + MAX_WORKERS)
+        if create:
+            with open(path, 'wb') as f:
+                f.truncate(header_size + 2 * 4 * n)
+        self.header = np.memmap(path, np.int64, 'r+', shape=(1 + MAX_WORKERS,))
+        data = np.memmap(path, np.float32, 'r+', offset=header_size, shape=(2 * n,))
+
+        '''views of every variable, in var_list order'''
+        self.params, self.ms = [], []
+        offset = 0
+        for shape, size in zip(self.shapes, self.sizes):
+            self.params += [data[offset:offset + size].reshape(shape)]
+            self.ms += [data[n + offset:n + offset + size].reshape(shape)]
+            offset += size
+
+    @property
+    def global_step(self):
+        return int(self.header.sum())
+
+    def add_steps(self, steps):
+        '''only this worker writes its counter, no increment is lost'''
+        self.header[1 + self.task] += steps
+        return self.global_step
+
+    def apply_gradients(self, grads):
+        '''one RMSProp step with the shared statistics, written in place'''
+        for param, ms, grad in zip(self.params, self.ms, grads):
+            ms *= self.decay
+            ms += (1.0 - self.decay) * np.square(grad)
+            param -= self.lr * grad / np.sqrt(ms + self.epsilon)
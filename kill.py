@@ -1,16 +1,78 @@
 import os
+import sys
+import time
+import signal
 import config
+import registry
 import subprocess
 
+alive = registry.pid_alive
+
+def terminate(pids, timeout):
+    """
+    ask pids to stop with SIGTERM and wait for them, roles flush their
+    buffers and checkpoints before exiting (see shutdown.py)
+    """
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + timeout
+    while time.time() < deadline and any(alive(pid) for pid in pids):
+        time.sleep(0.5)
+    running = [pid for pid in pids if alive(pid)]
+    if len(running) > 0:
+        print('Still running after {:.0f}s: {}'.format(timeout, ' '.join(str(pid) for pid in running)))
+
+def pane_processes(session):
+    '''the processes started in the shells of the tmux windows'''
+    try:
+        panes = subprocess.check_output(["tmux", "list-panes", "-s", "-t", session, "-F", "#{pane_pid}"])
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    pids = []
+    for pane in panes.split():
+        try:
+            children = subprocess.check_output(["pgrep", "-P", str(int(pane))])
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        pids += [int(pid) for pid in children.split()]
+    return pids
+
+def stop(session, entry, timeout):
+    '''stop a job the way it was launched'''
+    mode = entry.get('mode', 'tmux')
+    if mode == 'tmux':
+        terminate(pane_processes(session), timeout)
+        os.system("tmux kill-session -t {}".format(session))
+    elif mode == 'supervise':
+        '''the supervisor stops its roles itself'''
+        terminate([entry['pid']], timeout + 15)
+    else:
+        subprocess.call(["sh", os.path.join(entry['logdir'], 'kill.sh')])
+
 def run():
 
-    session = "a3c"
+    '''python kill.py [experiment], python kill.py --list'''
+    if len(sys.argv) > 1 and sys.argv[1] == '--list':
+        for session, entry in sorted(registry.load().items()):
+            print('{} mode={} ports={}-{} logdir={} started={}'.format(
+                session, entry['mode'], entry['ports'][0], entry['ports'][-1], entry['logdir'], entry['started']))
+        return
+    experiment = sys.argv[1] if len(sys.argv) > 1 else ''
+    session = registry.session_name(experiment)
 
-    cmds = [
-        "tmux kill-session -t {}".format(session),
-    ]
-    '''excute cmds'''
-    os.system("\n".join(cmds))
+    with registry.locked() as experiments:
+        entry = experiments.pop(session, None)
+    if entry is None:
+        '''not registered, launched by an older train.py'''
+        entry = {'mode': 'tmux'}
+    stop(session, entry, timeout=75.0)
+    if entry.get('backend') == 'hogwild':
+        '''the shared parameters of the job are in /dev/shm, which is memory'''
+        from hogwild import default_path
+        subprocess.call(["rm", "-f", default_path(entry['logdir'])])
 
     subprocess.call(["rm", "-r", 'temp'])
 
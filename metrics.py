@@ -0,0 +1,251 @@
+"""
+Throughput metrics of every process of a job, in the Prometheus text format.
+
+Modules create their metrics once, at import, with counter(), gauge() and
+summary(), and update them from any thread.  A process that calls start()
+writes all of them every interval seconds to <logdir>/metrics/<role>.prom,
+and also serves them over http on the local machine when given a port, so
+they can be scraped as they are.
+
+Run this module to see the whole job in one view:
+
+    python metrics.py <logdir> [--interval 10] [--once]
+
+it reads the files of all roles twice, interval seconds apart, and prints
+counters as rates per second, gauges as they are and summaries as means.
+"""
+from __future__ import print_function
+from six.moves import BaseHTTPServer
+import argparse
+import glob
+import math
+import os
+import threading
+import time
+
+_metrics = []
+_metrics_lock = threading.Lock()
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def samples(self):
+        '''the (sample name, value) pairs of the metric, exposition() lists none for a metric without samples'''
+        return []
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help)
+        self.value = 0.0
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help)
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = float(value)
+
+    def set_function(self, function):
+        '''the value is read from function whenever the metrics are written'''
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [(self.name, float(self.function()))]
+            except Exception:
+                return [(self.name, float('nan'))]
+        return [(self.name, self.value)]
+
+class Summary(Metric):
+    type = 'summary'
+
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + '_sum', self.sum), (self.name + '_count', float(self.count))]
+
+def _get_or_create(cls, name, help):
+    with _metrics_lock:
+        for metric in _metrics:
+            if metric.name == name:
+                assert isinstance(metric, cls), name
+                return metric
+        metric = cls(name, help)
+        _metrics.append(metric)
+        return metric
+
+def counter(name, help=''):
+    return _get_or_create(Counter, name, help)
+
+def gauge(name, help=''):
+    return _get_or_create(Gauge, name, help)
+
+def summary(name, help=''):
+    return _get_or_create(Summary, name, help)
+
+def format_value(value):
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value))
+
+def exposition(role):
+    """all metrics of this process, in the Prometheus text format"""
+    lines = []
+    with _metrics_lock:
+        metrics = list(_metrics)
+    for metric in metrics:
+        lines += ['# HELP {} {}'.format(metric.name, metric.help)]
+        lines += ['# TYPE {} {}'.format(metric.name, metric.type)]
+        for name, value in metric.samples():
+            lines += ['{}{{role="{}"}} {}'.format(name, role, format_value(value))]
+    return '\n'.join(lines) + '\n'
+
+class Exporter(threading.Thread):
+    """
+    Writes the metrics of the process to <logdir>/metrics/<role>.prom every
+    interval seconds, replacing the file at once so readers never see half of it
+    """
+    def __init__(self, role, logdir, interval=10.0, port=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.role = role
+        self.path = os.path.join(logdir, 'metrics', role + '.prom')
+        self.interval = interval
+        self.port = port
+
+    def run(self):
+        if self.port is not None:
+            self.serve()
+        while True:
+            self.write()
+            time.sleep(self.interval)
+
+    def write(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                pass
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(exposition(self.role))
+        os.rename(tmp_path, self.path)
+
+    def serve(self):
+        role = self.role
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exposition(role).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', self.port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+def start(role, logdir, interval=10.0, port=None):
+    exporter = Exporter(role, logdir, interval, port)
+    exporter.start()
+    return exporter
+
+def parse(text):
+    """Prometheus text -> {(role, sample name): value}"""
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name_labels, value = line.rsplit(' ', 1)
+        name, labels = name_labels.split('{', 1)
+        role = labels.split('role="', 1)[1].split('"', 1)[0]
+        values[(role, name)] = float(value)
+    return values
+
+def read_all(logdir):
+    values, types = {}, {}
+    for path in glob.glob(os.path.join(logdir, 'metrics', '*.prom')):
+        with open(path) as f:
+            text = f.read()
+        values.update(parse(text))
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                _, _, name, type = line.split(' ')
+                types[name] = type
+    return values, types
+
+def report(before, after, types, elapsed):
+    """one line per role, counters as rates per second"""
+    lines = []
+    for role in sorted(set(role for role, _ in after)):
+        fields = []
+        for (r, name), value in sorted(after.items()):
+            if r != role:
+                continue
+            if types.get(name) == 'counter':
+                rate = (value - before.get((r, name), value)) / elapsed
+                fields += ['{}/s={:.1f}'.format(name.replace('_total', ''), rate)]
+            elif types.get(name) == 'gauge':
+                fields += ['{}={:.3g}'.format(name, value)]
+            elif name.endswith('_count'):
+                base = name[:-len('_count')]
+                count = value - before.get((r, name), 0.0)
+                total = after.get((r, base + '_sum'), 0.0) - before.get((r, base + '_sum'), 0.0)
+                if count > 0:
+                    fields += ['{}={:.3g}'.format(base, total / count)]
+        lines += ['{:>16} {}'.format(role, ' '.join(fields))]
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the metrics of all roles of a job')
+    parser.add_argument('logdir', help='Log directory of the job')
+    parser.add_argument('--interval', default=10.0, type=float, help='Seconds between the two reads rates are computed from')
+    parser.add_argument('--once', action='store_true', help='Print one report and exit instead of refreshing')
+    args = parser.parse_args()
+
+    before, _ = read_all(args.logdir)
+    while True:
+        time.sleep(args.interval)
+        after, types = read_all(args.logdir)
+        print('==== ' + time.strftime('%H:%M:%S'))
+        print('\n'.join(report(before, after, types, args.interval)))
+        before = after
+        if args.once:
+            break
+
+if __name__ == "__main__":
+    main()
@@ -44,14 +44,17 @@ def categorical_sample(logits, d):
     value = tf.squeeze(tf.multinomial(logits - tf.reduce_max(logits, [1], keep_dims=True), 1), [1])
     return tf.one_hot(value, d)
 
+def conv_features(x):
+    for i in range(4):
+        x = tf.nn.elu(conv2d(x, 32, "l{}".format(i + 1), [3, 3], [2, 2]))
+    return flatten(x)
+
 class LSTMPolicy(object):
     def __init__(self, ob_space, ac_space):
         self.x = x = tf.placeholder(tf.float32, [None] + list(ob_space))
 
-        for i in range(4):
-            x = tf.nn.elu(conv2d(x, 32, "l{}".format(i + 1), [3, 3], [2, 2]))
         # introduce a "fake" batch dimension of 1 after flatten so that we can do LSTM over time dim
-        x = tf.expand_dims(flatten(x), [0])
+        x = tf.expand_dims(conv_features(x), [0])
 
         size = 256
         if use_tf100_api:
@@ -83,6 +86,27 @@ class LSTMPolicy(object):
         self.sample = categorical_sample(self.logits, ac_space)[0, :]
         self.var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, tf.get_variable_scope().name)
 
+        # a single LSTM step for a batch of environments, sharing the variables above.
+        # here the batch dimension holds the environments and every sequence has length 1
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            self.batch_x = tf.placeholder(tf.float32, [None] + list(ob_space))
+            batch_c_in = tf.placeholder(tf.float32, [None, lstm.state_size.c])
+            batch_h_in = tf.placeholder(tf.float32, [None, lstm.state_size.h])
+            self.batch_state_in = [batch_c_in, batch_h_in]
+
+            if use_tf100_api:
+                batch_state_in = rnn.LSTMStateTuple(batch_c_in, batch_h_in)
+            else:
+                batch_state_in = rnn.rnn_cell.LSTMStateTuple(batch_c_in, batch_h_in)
+            x = tf.expand_dims(conv_features(self.batch_x), [1])
+            lstm_outputs, lstm_state = tf.nn.dynamic_rnn(
+                lstm, x, initial_state=batch_state_in, time_major=False)
+            x = tf.reshape(lstm_outputs, [-1, size])
+            batch_logits = linear(x, ac_space, "action")
+            self.batch_vf = tf.reshape(linear(x, 1, "value"), [-1])
+            self.batch_state_out = [lstm_state[0], lstm_state[1]]
+            self.batch_sample = categorical_sample(batch_logits, ac_space)
+
     def get_initial_features(self):
         return self.state_init
 
@@ -94,3 +118,16 @@ class LSTMPolicy(object):
     def value(self, ob, c, h):
         sess = tf.get_default_session()
         return sess.run(self.vf, {self.x: [ob], self.state_in[0]: c, self.state_in[1]: h})[0]
+
+    def act_batch(self, obs, c, h):
+        """
+        act in several environments with one session call,
+        obs are stacked observations, c and h are stacked per-env lstm states
+        """
+        sess = tf.get_default_session()
+        return sess.run([self.batch_sample, self.batch_vf] + self.batch_state_out,
+                        {self.batch_x: obs, self.batch_state_in[0]: c, self.batch_state_in[1]: h})
+
+    def value_batch(self, obs, c, h):
+        sess = tf.get_default_session()
+        return sess.run(self.batch_vf, {self.batch_x: obs, self.batch_state_in[0]: c, self.batch_state_in[1]: h})
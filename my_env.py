@@ -1,6 +1,12 @@
 import numpy as np
+import gym
+from gym import spaces
+from gym.spaces.box import Box
 import config
 import time
+
+GRID_ENV_ID = 'GmbrlGrid-v0'
+
 def get_grid_observation(x, y):
     observation = np.ones((config.gan_size,config.gan_size))
     observation[x*(config.gan_size/config.grid_size):(x+1)*(config.gan_size/config.grid_size),y*(config.gan_size/config.grid_size):(y+1)*(config.gan_size/config.grid_size)] = 0.0
@@ -9,6 +15,12 @@ def get_grid_observation(x, y):
     observation = np.concatenate((observation,observation,observation),
                                  axis=0)
     return observation
+def observation_reward(observation):
+    '''reward of a (possibly predicted) observation: 1 when the player is on the target cell'''
+    cell = config.gan_size/config.grid_size
+    target = observation[:,config.grid_target_x*cell:(config.grid_target_x+1)*cell,config.grid_target_y*cell:(config.grid_target_y+1)*cell]
+    return 1.0 if np.mean(target) < 0.5 else 0.0
+
 class env():
     def __init__(self):
         self.will_reset = False
@@ -106,4 +118,30 @@ class env():
 
         self.update_observation()
 
-        return self.observation, self.reward, self.done
\ No newline at end of file
+        return self.observation, self.reward, self.done
+
+class GridEnv(gym.Env):
+    """
+    gym interface to the grid world, registered as GRID_ENV_ID.
+    Like universe envs it resets itself: the step that ends an episode
+    returns the first observation of the next one.
+    """
+    metadata = {'semantics.autoreset': True}
+
+    def __init__(self):
+        self.grid = env()
+        self.action_space = spaces.Discrete(config.action_space)
+        self.observation_space = Box(0.0, 1.0, [3, config.gan_size, config.gan_size])
+
+    def reset(self):
+        return self.grid.get_initial_observation()
+
+    def step(self, action):
+        observation, reward, done = self.grid.act(int(action))
+        return observation, reward, done, {}
+
+gym.envs.registration.register(
+    id=GRID_ENV_ID,
+    entry_point='my_env:GridEnv',
+    tags={'grid': True},
+)
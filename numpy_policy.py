@@ -0,0 +1,124 @@
+import numpy as np
+import threading
+
+def elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+def conv2d_same(x, w, b, stride):
+    """
+    numpy version of tf.nn.conv2d(x, w, [1, stride, stride, 1], "SAME") + b
+    x is [batch, height, width, in], w is [kh, kw, in, out]
+    """
+    n, height, width, _ = x.shape
+    kh, kw, _, out = w.shape
+    out_h = (height + stride - 1) // stride
+    out_w = (width + stride - 1) // stride
+
+    # tensorflow puts the extra padding pixel at the bottom / right
+    pad_h = max((out_h - 1) * stride + kh - height, 0)
+    pad_w = max((out_w - 1) * stride + kw - width, 0)
+    x = np.pad(x, ((0, 0), (pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2), (0, 0)), 'constant')
+
+    y = np.zeros((n, out_h, out_w, out), np.float32)
+    for i in range(kh):
+        for j in range(kw):
+            y += x[:, i:i + stride * out_h:stride, j:j + stride * out_w:stride, :].dot(w[i, j])
+    return y + b.reshape(-1)
+
+class NumpyPolicy(object):
+    """
+    Acting engine that runs the forward pass of a model.LSTMPolicy in numpy.
+
+    The weights of the local network are mirrored into numpy arrays by load(),
+    which A3C calls right after every sync, so acting does not go through a
+    session call at all. act, value, act_batch and value_batch return the same
+    structures as the LSTMPolicy methods they replace.
+    """
+    def __init__(self, policy, forget_bias=1.0):
+        self.policy = policy
+        self.global_step = policy.global_step
+        self.forget_bias = forget_bias
+        self.weights = None
+        self.lock = threading.Lock()
+
+    def get_initial_features(self):
+        return self.policy.get_initial_features()
+
+    def load(self, sess):
+        """mirror the current weights of the local network"""
+        values = sess.run(self.policy.var_list)
+        weights = {}
+        for var, value in zip(self.policy.var_list, values):
+            name = var.name.split(':')[0]
+            if 'lstm' in name.lower():
+                weights['lstm/w' if value.ndim == 2 else 'lstm/b'] = value
+            else:
+                weights['/'.join(name.split('/')[-2:])] = value
+
+        # swap the whole set at once, the runner thread may be acting right now
+        with self.lock:
+            self.weights = weights
+
+    def check(self, sess, atol=1e-4):
+        """
+        run the loaded weights and the local network on the same random
+        observation and lstm state, and raise AssertionError unless their
+        logits, value and next state agree within atol
+        """
+        policy = self.policy
+        ob = np.random.uniform(size=policy.x.get_shape().as_list()[1:]).astype(np.float32)
+        c, h = [np.random.uniform(-1.0, 1.0, size=np.shape(f)).astype(np.float32) for f in self.get_initial_features()]
+        expected = sess.run([policy.logits, policy.vf] + policy.state_out,
+                            {policy.x: [ob], policy.state_in[0]: c, policy.state_in[1]: h})
+        actual = self.forward([ob], c, h)
+        for name, e, a in zip(['logits', 'value', 'c', 'h'], expected, actual):
+            if not np.allclose(e, a, atol=atol):
+                raise AssertionError('numpy policy does not match the local network on {}, max difference {}'.format(
+                    name, np.abs(np.asarray(e) - np.asarray(a)).max()))
+
+    def forward(self, obs, c, h):
+        with self.lock:
+            weights = self.weights
+
+        x = np.asarray(obs, np.float32)
+        for i in range(4):
+            layer = 'l{}'.format(i + 1)
+            x = elu(conv2d_same(x, weights[layer + '/W'], weights[layer + '/b'], 2))
+        x = x.reshape(x.shape[0], -1)
+
+        # one step of BasicLSTMCell
+        gates = np.concatenate([x, h], 1).dot(weights['lstm/w']) + weights['lstm/b']
+        i, j, f, o = np.split(gates, 4, axis=1)
+        c = c * sigmoid(f + self.forget_bias) + sigmoid(i) * np.tanh(j)
+        h = np.tanh(c) * sigmoid(o)
+
+        logits = h.dot(weights['action/w']) + weights['action/b']
+        vf = (h.dot(weights['value/w']) + weights['value/b']).reshape(-1)
+        return logits, vf, c, h
+
+    def sample(self, logits):
+        logits = logits - logits.max(1, keepdims=True)
+        prob = np.exp(logits)
+        cdf = np.cumsum(prob, 1)
+        u = np.random.uniform(size=(logits.shape[0], 1)) * cdf[:, -1:]
+        action = np.minimum((cdf < u).sum(1), logits.shape[1] - 1)
+        one_hot = np.zeros(logits.shape, np.float32)
+        one_hot[np.arange(logits.shape[0]), action] = 1.0
+        return one_hot
+
+    def act(self, ob, c, h):
+        logits, vf, c, h = self.forward([ob], c, h)
+        return [self.sample(logits)[0], vf, c, h]
+
+    def value(self, ob, c, h):
+        return self.forward([ob], c, h)[1][0]
+
+    def act_batch(self, obs, c, h):
+        logits, vf, c, h = self.forward(obs, c, h)
+        return [self.sample(logits), vf, c, h]
+
+    def value_batch(self, obs, c, h):
+        return self.forward(obs, c, h)[1]
@@ -0,0 +1,72 @@
+"""
+Overrides of the settings in config.py, for one run.
+
+config.py reads them from the GMBRL_CONFIG_OVERRIDES environment variable, a
+json dict, so they reach every process of a run.  Entry points accept them
+on the command line as --set key=value, which from_argv() moves into the
+environment; it has to run before config is imported:
+
+    import overrides
+    overrides.from_argv()
+    import config
+
+Values are parsed as json when they can be (--set gan_nz=128 is a number),
+and kept as strings otherwise (--set lable=baseline).
+"""
+import json
+import os
+import sys
+
+ENV_VAR = 'GMBRL_CONFIG_OVERRIDES'
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def parse(pairs):
+    """['gan_nz=128', 'lable=baseline'] -> {'gan_nz': 128, 'lable': 'baseline'}"""
+    values = {}
+    for pair in pairs:
+        if '=' not in pair:
+            raise ValueError('Config overrides are key=value, got ' + pair)
+        key, value = pair.split('=', 1)
+        values[key.strip()] = parse_value(value)
+    return values
+
+def load():
+    return json.loads(os.environ.get(ENV_VAR, '{}'))
+
+def save(values):
+    if len(values) > 0:
+        os.environ[ENV_VAR] = json.dumps(values, sort_keys=True)
+
+def from_argv(argv=None):
+    """move --set key=value (or --set=key=value) out of argv, into the environment"""
+    if argv is None:
+        argv = sys.argv
+    pairs, rest = [], [argv[0]]
+    i = 1
+    while i < len(argv):
+        if argv[i] == '--set' and i + 1 < len(argv):
+            pairs.append(argv[i + 1])
+            i += 2
+        elif argv[i].startswith('--set='):
+            pairs.append(argv[i][len('--set='):])
+            i += 1
+        else:
+            rest.append(argv[i])
+            i += 1
+    argv[:] = rest
+
+    values = load()
+    values.update(parse(pairs))
+    save(values)
+    return values
+
+def env_assignment():
+    '''the overrides of this process as a VAR=value for env, None when there are none'''
+    if not os.environ.get(ENV_VAR):
+        return None
+    return ENV_VAR + '=' + os.environ[ENV_VAR]
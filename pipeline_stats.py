@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+import numpy as np
+import threading
+import time
+
+class PipelineStats(object):
+    """
+    Timings of the acting -> queue -> learning pipeline of one worker.
+
+    Stages are timed with timer(name) and the runner queue occupancy is sampled
+    with observe_queue() on every put and get.  snapshot() reduces everything
+    recorded since the previous snapshot into flat scalars:
+
+        pipeline/<stage>_ms      mean latency of the stage
+        pipeline/<stage>_frac    fraction of wall time spent in the stage
+        pipeline/queue_<k>       fraction of samples with k rollouts queued
+
+    A runner that is often blocked in queue_put waits for the learner, a learner
+    that is often blocked in queue_get waits for acting.
+    """
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.times = {}
+        self.occupancy = np.zeros(self.queue_size + 1, np.int64)
+
+    def record(self, name, seconds):
+        with self.lock:
+            total, count = self.times.get(name, (0.0, 0))
+            self.times[name] = (total + seconds, count + 1)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        yield
+        self.record(name, time.time() - start)
+
+    def observe_queue(self, size):
+        with self.lock:
+            self.occupancy[min(size, self.queue_size)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.start_time, 1e-6)
+            times, occupancy = self.times, self.occupancy
+            self.reset()
+
+        scalars = {}
+        for name, (total, count) in times.items():
+            scalars['pipeline/%s_ms' % name] = 1000.0 * total / count
+            scalars['pipeline/%s_frac' % name] = total / elapsed
+        samples = max(occupancy.sum(), 1)
+        for k in range(self.queue_size + 1):
+            scalars['pipeline/queue_%d' % k] = float(occupancy[k]) / samples
+        return scalars
+
+    @staticmethod
+    def bottleneck(scalars):
+        put = scalars.get('pipeline/queue_put_frac', 0.0)
+        get = scalars.get('pipeline/queue_get_frac', 0.0)
+        return 'learner' if put > get else 'acting'
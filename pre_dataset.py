@@ -1,64 +1,161 @@
 #!/usr/bin/env python
 # coding=utf-8
-import matplotlib as plt
+"""
+Turns config.video_name into the offline dataset of run_gan_predict.py: one
+frame every config.gan_predict_interval seconds, resized to gan_size.  The
+frames are stored once, the trainer samples the 4-frame windows
+[lllast, llast, last, image] of consecutive steps from them (see dataset_io.py).
+
+The steps are split into ranges of --chunk-steps, processed by a pool of
+--processes workers, each with its own reader of the video.  A worker seeks
+once to the start of its range and decodes it sequentially, in a thread that
+keeps one frame per step and hands it to resizing through a queue of at most
+--queue-frames frames, so no frame is decoded twice.  Workers write every
+frame straight into the dataset preallocated on disk, so memory stays
+bounded however long the video is.
+"""
+from __future__ import print_function
+import startup
+import argparse
+import multiprocessing
+import threading
+import time
+import six.moves.queue as queue
 import imageio
 import numpy as np
 import config
 import cv2
-import copy
-import subprocess
-file = config.video_name
-dataset_file = config.dataset_name
-dir = config.dataset_path
-filename = dir + file
-vid = imageio.get_reader(filename,  'ffmpeg')
-info = vid.get_meta_data()
-num_frame = info['nframes']
-size = info['size']
-print info
-num_step = int(info['duration']/config.gan_predict_interval)
-frame_per_step = num_frame / num_step
-lllast_image = None
-llast_image = None
-last_image = None
-dataset = []
-for step in range(0, num_step):
+import dataset_io
 
-    frame = step * frame_per_step
+parser = argparse.ArgumentParser(description="Preprocess a video into the dataset of run_gan_predict.py")
+parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help="Worker processes decoding and resizing frames")
+parser.add_argument('--chunk-steps', type=int, default=1024, help="Steps every worker processes at once, with one seek")
+parser.add_argument('--queue-frames', type=int, default=16, help="Decoded frames a worker holds while they wait to be resized")
 
-    image = np.asarray(vid.get_data(frame))/255.0
+'''reader of the video, the frames on disk and the queue size of a worker process'''
+_vid = None
+_frames = None
+_queue_frames = None
 
-    c = []
-    for color in range(3):
-        temp = np.asarray(cv2.resize(image[:,:,color], (config.gan_size, config.gan_size)))
-        temp = np.expand_dims(temp,0)
-        c += [copy.deepcopy(temp)]
+def preprocess(image):
+    """one frame of the video -> [nc, gan_size, gan_size] in [0, 1]"""
+    image = np.asarray(image, dtype=np.float32) / 255.0
+    c = [np.expand_dims(cv2.resize(image[:,:,color], (config.gan_size, config.gan_size)), 0) for color in range(3)]
 
-    if config.gan_nc is 1:
-        image = np.asarray(np.add(c[0]*0.299,c[1]*0.587))
-        image = np.asarray(np.add(image,c[2]*0.114))
-    elif config.gan_nc is 3:
+    if config.gan_nc == 1:
+        image = c[0]*0.299 + c[1]*0.587 + c[2]*0.114
+    elif config.gan_nc == 3:
         image = np.concatenate((c[0],c[1],c[2]),0)
+    return image
+
+def open_worker(filename, dataset_path, queue_frames):
+    global _vid, _frames, _queue_frames
+    _vid = imageio.get_reader(filename, 'ffmpeg')
+    _frames = np.load(dataset_path, mmap_mode='r+')
+    _queue_frames = queue_frames
 
-    print 'video>'+str(file)+'\t'+'step>'+str(step)+'\t'+'size>'+str(np.shape(image))
-    
-    if last_image is None or llast_image is None or lllast_image is None:
+def decode(first, end, frame_per_step, decoded, errors, stop):
+    """
+    put (step, frame) of steps first to end - 1 into decoded, then None.
+    Only the first frame is sought, the others are read in order, skipping
+    the frames between two steps.  Stops early once stop is set
+    """
+    try:
+        image = _vid.get_data(first * frame_per_step)
+        for step in range(first, end):
+            if stop.is_set():
+                break
+            decoded.put((step, image))
+            if step + 1 < end:
+                for _ in range(frame_per_step):
+                    image = _vid.get_next_data()
+    except IndexError:
+        '''nframes of the metadata can count a few frames more than the stream has'''
         pass
-    else:
-        pair = [lllast_image,llast_image,last_image,image]
-        dataset += [copy.deepcopy(np.asarray(pair))]
+    except Exception as e:
+        errors.append(e)
+    finally:
+        decoded.put(None)
+
+def process_steps(steps):
+    """
+    preprocess the frames of steps = (first, end, frame_per_step) into the
+    dataset, returns first and the number of steps decoded from there on
+    """
+    first, end, frame_per_step = steps
+    decoded = queue.Queue(maxsize=_queue_frames)
+    errors = []
+    stop = threading.Event()
+    decoder = threading.Thread(target=decode, args=(first, end, frame_per_step, decoded, errors, stop))
+    decoder.daemon = True
+    decoder.start()
 
-    lllast_image = copy.deepcopy(llast_image)
-    llast_image = copy.deepcopy(last_image)
-    last_image = copy.deepcopy(image)
+    done = 0
+    try:
+        while True:
+            item = decoded.get()
+            if item is None:
+                break
+            step, image = item
+            _frames[step] = preprocess(image)
+            done += 1
+    except Exception:
+        '''let the decoder finish before the next chunk of this process uses the reader'''
+        stop.set()
+        while decoded.get() is not None:
+            pass
+        decoder.join()
+        raise
+    decoder.join()
+    if len(errors) > 0:
+        raise errors[0]
+    _frames.flush()
+    return first, done
 
-dataset = np.asarray(dataset)
+def main():
+    args = parser.parse_args()
+    file = config.video_name
+    dataset_file = config.dataset_name
+    dir = config.dataset_path
+    filename = dir + file
 
-print 'genrate dataset with size>'+str(np.shape(dataset))
+    vid = imageio.get_reader(filename, 'ffmpeg')
+    info = vid.get_meta_data()
+    vid.close()
+    print(info)
+    num_frame = info['nframes']
+    num_step = int(info['duration']/config.gan_predict_interval)
+    frame_per_step = num_frame // num_step
+    startup.mark('open_video')
+    startup.report('pre_dataset', dir)
 
-np.savez(dir+dataset_file,
-         dataset=dataset)
+    '''the frames are filled in place, in the dataset run_gan_predict.py maps'''
+    dataset_path = dir + dataset_file
+    dataset = dataset_io.create(dataset_path, (num_step, config.gan_nc, config.gan_size, config.gan_size),
+                                video=file, gan_predict_interval=config.gan_predict_interval,
+                                gan_size=config.gan_size, gan_nc=config.gan_nc)
+    del dataset
 
-print(s)
+    chunks = [(first, min(first + args.chunk_steps, num_step), frame_per_step)
+              for first in range(0, num_step, args.chunk_steps)]
+    print('video>{} steps>{} chunks>{} processes>{}'.format(file, num_step, len(chunks), args.processes))
+    pool = multiprocessing.Pool(args.processes, initializer=open_worker, initargs=(filename, dataset_path, args.queue_frames))
+    start = time.time()
+    done = 0
+    '''the stream can end before the steps counted from its metadata, the frames after its end stay out of the dataset'''
+    num_frames = num_step
+    for first, steps in pool.imap_unordered(process_steps, chunks):
+        done += steps
+        if first + steps < min(first + args.chunk_steps, num_step):
+            num_frames = min(num_frames, first + steps)
+        print('video>{}\tsteps>{}/{}\t{:.1f} steps/s'.format(file, done, num_step, done / (time.time() - start)))
+    pool.close()
+    pool.join()
+    if num_frames < num_step:
+        print('video>{} ended {} steps early, the dataset keeps its first {} frames'.format(file, num_step - num_frames, num_frames))
+        dataset_io.set_num_frames(dataset_path, num_frames)
 
+    print('genrate dataset with frames>'+str(dataset_io.open_dataset(dataset_path).shape))
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Profiling of a running process, started and stopped by a signal.
+
+install() registers a handler for SIGUSR1.  The first signal starts cProfile
+in the main thread and a sampler of the stacks of all threads; the second
+signal, or the end of the window, stops both and writes to <logdir>/profile/:
+
+    <role>-<pid>-<time>.pstats   cProfile stats, for pstats or snakeviz
+    <role>-<pid>-<time>.txt      the top functions by cumulative time
+    <role>-<pid>-<time>.stacks   stack samples of every thread, one folded
+                                 stack and its count per line (flamegraph.pl)
+
+Nothing runs while the profiler is idle, besides the installed handler.
+
+    kill -USR1 <pid>     # start, stops by itself after the window
+"""
+from __future__ import print_function
+from collections import Counter
+import cProfile
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+
+class StackSampler(threading.Thread):
+    """counts the stacks of all other threads, every interval seconds"""
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self.stop_event.is_set():
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.stacks[names.get(ident, str(ident)) + ';' + ';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+class SignalProfiler(object):
+    def __init__(self, logdir, role, signum, window, sample_interval):
+        self.dir = os.path.join(logdir, 'profile')
+        self.role = role
+        self.signum = signum
+        self.window = window
+        self.sample_interval = sample_interval
+        self.profile = None
+        self.sampler = None
+        self.timer = None
+        self.start_time = None
+
+    def handle(self, signum, frame):
+        if self.profile is None:
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        print('[profiler] profiling {} for at most {:.0f}s'.format(self.role, self.window))
+        self.start_time = time.time()
+        self.sampler = StackSampler(self.sample_interval)
+        self.sampler.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+        # the window ends with the same signal, so that the profile is stopped
+        # in the main thread, where it was enabled
+        self.timer = threading.Timer(self.window, os.kill, args=(os.getpid(), self.signum))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def stop(self):
+        self.profile.disable()
+        self.timer.cancel()
+        self.sampler.stop()
+        profile, sampler, self.profile, self.sampler = self.profile, self.sampler, None, None
+
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        prefix = os.path.join(self.dir, '{}-{}-{}'.format(self.role, os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        profile.dump_stats(prefix + '.pstats')
+        with open(prefix + '.txt', 'w') as f:
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(50)
+        with open(prefix + '.stacks', 'w') as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        print('[profiler] {:.1f}s of {} written to {}.*'.format(time.time() - self.start_time, self.role, prefix))
+
+def install(logdir, role, signum=signal.SIGUSR1, window=60.0, sample_interval=0.01):
+    """profile this process for at most window seconds whenever it gets signum"""
+    profiler = SignalProfiler(logdir, role, signum, window, sample_interval)
+    signal.signal(signum, profiler.handle)
+    return profiler
@@ -0,0 +1,113 @@
+"""
+Registry of the experiments running on this machine.
+
+train.py registers every job it launches, under its session name, with the
+ports it allocated and how to stop it, and kill.py stops jobs by name from
+it.  Ports are allocated as one free contiguous range per job, skipping the
+ranges of the registered jobs, so several jobs can share a machine.
+
+Jobs that died without kill.py, with their tmux session or processes killed
+some other way, are dropped from the registry whenever it is read, so their
+ports are free again.
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import socket
+import subprocess
+import time
+
+REGISTRY_PATH = os.path.join(os.path.expanduser('~'), '.gmbrl', 'experiments.json')
+
+@contextmanager
+def locked(path=REGISTRY_PATH):
+    """the registered jobs, read and written back under an exclusive lock"""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            experiments = load(path)
+            yield experiments
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(experiments, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def load(path=REGISTRY_PATH):
+    """the registered jobs that are still running"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        experiments = json.load(f)
+    return dict((session, entry) for session, entry in experiments.items() if running(session, entry))
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+def job_pids(entry):
+    '''the pids the kill.sh of a nohup or child job kills'''
+    try:
+        with open(os.path.join(entry['logdir'], 'kill.sh')) as f:
+            return [int(line.split()[1]) for line in f if line.startswith('kill ')]
+    except (IOError, OSError, ValueError, IndexError):
+        return []
+
+def running(session, entry, grace=60.0):
+    """
+    whether the job of entry still runs.  It is registered before its
+    processes start, so a job younger than grace seconds counts as running
+    """
+    try:
+        started = time.mktime(time.strptime(entry['started'], '%Y-%m-%d %H:%M:%S'))
+    except (KeyError, ValueError):
+        started = 0.0
+    if time.time() - started < grace:
+        return True
+    mode = entry.get('mode', 'tmux')
+    if mode == 'tmux':
+        with open(os.devnull, 'w') as devnull:
+            try:
+                return subprocess.call(['tmux', 'has-session', '-t', session], stdout=devnull, stderr=devnull) == 0
+            except OSError:
+                return False
+    if mode == 'supervise':
+        return pid_alive(entry['pid'])
+    return any(pid_alive(pid) for pid in job_pids(entry))
+
+def port_free(port, host='127.0.0.1'):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+def allocate_ports(count, experiments, first=12222, last=32767):
+    """first port of a range of count free ports, that no registered job uses"""
+    reserved = set()
+    for entry in experiments.values():
+        reserved.update(entry.get('ports', []))
+    port = first
+    while port + count - 1 <= last:
+        for i in range(count):
+            if port + i in reserved or not port_free(port + i):
+                '''restart after the port in use'''
+                port += i + 1
+                break
+        else:
+            return port
+    raise RuntimeError('No {} free ports in {}-{}'.format(count, first, last))
+
+def session_name(experiment):
+    '''the default experiment keeps the historical session name'''
+    return 'a3c-' + experiment if experiment else 'a3c'
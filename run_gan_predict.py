@@ -1,27 +1,27 @@
 from __future__ import print_function
+import startup
+import overrides
+overrides.from_argv()
 import argparse
+import cpu_plan
+import json
+from collections import deque
 import random
 import torch
-import torch.nn as nn
-import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
-import torch.utils.data
-import torchvision.datasets as dset
-import torchvision.transforms as transforms
-import torchvision.utils as vutils
 from torch.autograd import Variable
-import os
 import numpy as np
-import copy
 
 import wgan_models.dcgan as dcgan
-import wgan_models.mlp as mlp
-import support_lib
+import sample_writer
+import dataset_io
+import metrics
+import profiler
 import config
 import subprocess
 import time
-import gsa_io
+startup.mark('imports')
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dataset', default='lsun', help='cifar10 | lsun | imagenet | folder | lfw ')
@@ -51,9 +51,16 @@ parser.add_argument('--mlp_D', action='store_true', help='use MLP for D')
 parser.add_argument('--n_extra_layers', type=int, default=0, help='Number of extra layers on gen and disc')
 parser.add_argument('--experiment', default=config.logdir, help='Where to store samples and models')
 parser.add_argument('--adam', action='store_true', help='Whether to use adam (default is rmsprop)')
+parser.add_argument('--metrics-port', type=int, default=None, help='Also serve the metrics over http on this port')
+parser.add_argument('--max-iters', type=int, default=None, help='Stop after this many iterations and write result.json, default: never stop')
+parser.add_argument('--cpus', default=None, help='Pin this process to these cores (e.g. 0-3)')
+parser.add_argument('--num-threads', type=int, default=None, help='Size of the torch thread pool, the number of --cpus by default')
 opt = parser.parse_args()
 print(opt)
 
+if opt.cpus is not None:
+    torch.set_num_threads(cpu_plan.apply(cpu_plan.parse_cpus(opt.cpus), opt.num_threads))
+
 subprocess.call(["mkdir", "-p", config.logdir])
 subprocess.call(["mkdir", "-p", config.modeldir])
 
@@ -61,6 +68,7 @@ subprocess.call(["mkdir", "-p", config.modeldir])
 opt.manualSeed = random.randint(1, 10000) # fix seed
 print("Random Seed: ", opt.manualSeed)
 random.seed(opt.manualSeed)
+np.random.seed(opt.manualSeed)
 torch.manual_seed(opt.manualSeed)
 
 cudnn.benchmark = True
@@ -124,12 +132,13 @@ fixed_noise = torch.FloatTensor(opt.batchSize, nz, 1, 1).normal_(0, 1)
 one = torch.FloatTensor([1])
 mone = one * -1
 
-'''load dataset'''
-dataset = np.load(config.dataset_path+config.dataset_name)['dataset']
-dataset_len = np.shape(dataset)[0]
-print('dataset loaded, size: ' + str(np.shape(dataset)))
-dataset = torch.FloatTensor(dataset)
-dataset_sampler_indexs = torch.LongTensor(opt.batchSize).random_(0,dataset_len)
+'''map dataset, the frames of each minibatch are read from disk when sampled'''
+dataset = dataset_io.open_dataset(config.dataset_path+config.dataset_name,
+                                  gan_size=config.gan_size, gan_nc=config.gan_nc)
+dataset_len = len(dataset_io.windows(dataset))
+print('dataset mapped, frames: ' + str(np.shape(dataset)) + ', windows: ' + str(dataset_len))
+
+startup.mark('load_dataset')
 
 if opt.cuda:
     netD.cuda()
@@ -140,7 +149,6 @@ if opt.cuda:
     one, mone = one.cuda(), mone.cuda()
     noise, fixed_noise = noise.cuda(), fixed_noise.cuda()
     # dataset = dataset.cuda()
-    # dataset_sampler_indexs = dataset_sampler_indexs.cuda()
 
 # setup optimizer
 if opt.adam:
@@ -153,8 +161,27 @@ else:
 
 iteration_i = 0
 dataset_i = 0
+last_save_time = None
+
+'''losses of the recent iterations, reported in result.json'''
+recent_loss_d = deque(maxlen=100)
+recent_loss_g = deque(maxlen=100)
+
+iterations = metrics.counter('gan_iterations_total', 'generator iterations of the gan')
+metrics.gauge('gan_checkpoint_age_seconds', 'seconds since the gan models were saved').set_function(
+    lambda: time.time() - last_save_time if last_save_time is not None else float('nan'))
 
-while True:
+'''write sample images off the training loop'''
+writer = sample_writer.SampleWriter()
+writer.start()
+
+startup.mark('build_gan')
+startup.report('run_gan_predict', config.logdir)
+train_start_time = time.time()
+metrics.start('run_gan_predict', config.logdir, port=opt.metrics_port)
+profiler.install(config.logdir, 'run_gan_predict')
+
+while opt.max_iters is None or iteration_i < opt.max_iters:
 
     ######################################################################
     ########################### Update D network #########################
@@ -203,12 +230,7 @@ while True:
         ######## train D network with real #######
 
         ## random sample from dataset ##
-        raw = torch.index_select(dataset,0,dataset_sampler_indexs.random_(0,dataset_len))
-        image = [] 
-        for image_i in range(4):
-            image += [raw.narrow(1,image_i,1)]
-        state_prediction_gt = torch.cat(image,2)
-        state_prediction_gt = torch.squeeze(state_prediction_gt,1)
+        state_prediction_gt = torch.from_numpy(dataset_io.sample(dataset, np.random.randint(0, dataset_len, opt.batchSize)))
         if opt.cuda:
             state_prediction_gt = state_prediction_gt.cuda()
         state = state_prediction_gt.narrow(1,0*nc,3*nc)
@@ -328,39 +350,46 @@ while True:
     print('[iteration_i:%d][dataset_i:%d] Loss_D: %f Loss_G: %f Loss_D_real: %f Loss_D_fake %f'
         % (iteration_i, iteration_i,
         errD.data[0], errG.data[0], errD_real.data[0], errD_fake.data[0]))
+    recent_loss_d.append(float(errD.data[0]))
+    recent_loss_g.append(float(errG.data[0]))
 
     '''log image result'''
     if iteration_i % 100 == 0:
 
-        '''function need for log image'''
-        def sample2image(sample):
-            if config.gan_nc is 1:
-                c = sample / 3.0
-                c = torch.unsqueeze(c,1)
-                save = torch.cat([c,c,c],1)
-            elif config.gan_nc is 3:
-                save = []
-                for image_i in range(4):
-                    save += [torch.unsqueeze(sample.narrow(0,image_i*3,3),0)]
-                save = torch.cat(save,0)
-            
-            # save = save.mul(0.5).add(0.5)
-            return save
-
         '''log real result'''
-        vutils.save_image(sample2image(state_prediction_gt[0]), '{0}/real_samples_{1}.png'.format(opt.experiment, iteration_i))
+        writer.submit(state_prediction_gt[0], '{0}/real_samples_{1}.png'.format(opt.experiment, iteration_i))
 
         '''log perdict result'''
-        vutils.save_image(sample2image(state_prediction[0]), '{0}/fake_samples_{1}.png'.format(opt.experiment, iteration_i))
+        writer.submit(state_prediction[0], '{0}/fake_samples_{1}.png'.format(opt.experiment, iteration_i))
 
         '''do checkpointing'''
         torch.save(netG_Cv.state_dict(), '{0}/{1}/netG_Cv.pth'.format(opt.experiment,config.gan_model_name_))
         torch.save(netG_DeCv.state_dict(), '{0}/{1}/netG_DeCv.pth'.format(opt.experiment,config.gan_model_name_))
         torch.save(netD.state_dict(), '{0}/{1}/netD.pth'.format(opt.experiment,config.gan_model_name_))
+        last_save_time = time.time()
 
     iteration_i += 1
+    iterations.inc()
     ######################################################################
     ######################### End One in Iteration  ######################
     ######################################################################
 
     
+
+'''do checkpointing, and report the run for sweep.py'''
+torch.save(netG_Cv.state_dict(), '{0}/{1}/netG_Cv.pth'.format(opt.experiment,config.gan_model_name_))
+torch.save(netG_DeCv.state_dict(), '{0}/{1}/netG_DeCv.pth'.format(opt.experiment,config.gan_model_name_))
+torch.save(netD.state_dict(), '{0}/{1}/netD.pth'.format(opt.experiment,config.gan_model_name_))
+seconds = time.time() - train_start_time
+result = {
+    'settings': overrides.load(),
+    'logdir': config.logdir,
+    'iterations': iteration_i,
+    'seconds': seconds,
+    'iters_per_sec': iteration_i / max(seconds, 1e-6),
+    'loss_d': float(np.mean(recent_loss_d)) if len(recent_loss_d) > 0 else None,
+    'loss_g': float(np.mean(recent_loss_g)) if len(recent_loss_g) > 0 else None,
+}
+with open(config.logdir+'result.json', 'w') as f:
+    json.dump(result, f, indent=2, sort_keys=True)
+print('Result: '+json.dumps(result, sort_keys=True))
@@ -22,6 +22,7 @@ import config
 import subprocess
 import time
 import gsa_io
+import profiler
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dataset', default='lsun', help='cifar10 | lsun | imagenet | folder | lfw ')
@@ -53,6 +54,9 @@ parser.add_argument('--adam', action='store_true', help='Whether to use adam (de
 opt = parser.parse_args()
 print(opt)
 
+# kill -USR1 profiles the training for a while
+profiler.install(config.logdir, 'run_wgan')
+
 # Where to store samples and models
 if opt.experiment is None:
     opt.experiment = 'samples'
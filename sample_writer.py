@@ -0,0 +1,87 @@
+from __future__ import print_function
+import torch
+import torchvision.utils as vutils
+import six.moves.queue as queue
+import threading
+import time
+import config
+
+def sample2image(sample):
+    '''turn one [4*nc, size, size] sample into a batch of 4 rgb images'''
+    if config.gan_nc == 1:
+        c = sample / 3.0
+        c = torch.unsqueeze(c,1)
+        save = torch.cat([c,c,c],1)
+    elif config.gan_nc == 3:
+        save = []
+        for image_i in range(4):
+            save += [torch.unsqueeze(sample.narrow(0,image_i*3,3),0)]
+        save = torch.cat(save,0)
+
+    # save = save.mul(0.5).add(0.5)
+    return save
+
+class SampleWriter(threading.Thread):
+    """
+    Writes sample images from a worker thread, so that png encoding and disk
+    writes stay off the training loop. The queue is bounded: when the writer
+    falls behind, new samples are dropped instead of blocking the trainer.
+    """
+    def __init__(self, maxsize=4):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue.Queue(maxsize)
+
+        '''timings, in seconds'''
+        self.num_submitted = 0
+        self.num_written = 0
+        self.num_dropped = 0
+        self.submit_time = 0.0
+        self.wait_time = 0.0
+        self.write_time = 0.0
+
+    def submit(self, sample, path, transform=sample2image):
+        """
+        copy sample to cpu and queue it to be written to path,
+        returns False if the sample was dropped
+        """
+        start = time.time()
+        self.num_submitted += 1
+
+        '''detach from the graph and from buffers the trainer keeps reusing'''
+        if hasattr(sample, 'data'):
+            sample = sample.data
+        sample = sample.cpu().clone()
+
+        try:
+            self.queue.put_nowait((sample, path, transform, time.time()))
+            queued = True
+        except queue.Full:
+            self.num_dropped += 1
+            queued = False
+        self.submit_time += time.time() - start
+        return queued
+
+    def run(self):
+        while True:
+            sample, path, transform, submitted = self.queue.get()
+            start = time.time()
+            self.wait_time += start - submitted
+            try:
+                if transform is not None:
+                    sample = transform(sample)
+                vutils.save_image(sample, path)
+            except Exception as e:
+                print('Failed to write sample '+path+': '+str(e))
+            self.write_time += time.time() - start
+            self.num_written += 1
+            self.report()
+
+    def report(self):
+        written = max(self.num_written, 1)
+        submitted = max(self.num_submitted, 1)
+        print('[sample_writer] written: %d dropped: %d submit: %.1fms queue_wait: %.1fms write: %.1fms'
+            % (self.num_written, self.num_dropped,
+            1000.0 * self.submit_time / submitted,
+            1000.0 * self.wait_time / written,
+            1000.0 * self.write_time / written))
@@ -0,0 +1,79 @@
+"""
+Coordinated shutdown of a role.
+
+The first SIGTERM, SIGINT or SIGHUP only requests the stop: the main loop of
+the role checks requested(), leaves the loop, and calls flush(), which runs
+the callbacks registered with on_stop() (saving transition buffers, writing
+a final checkpoint, ...) in the order they were registered, and then exit().
+If the role has not exited deadline seconds after the request, or when a
+second signal comes in, the process exits at once with 128 + signal.
+"""
+from __future__ import print_function
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+class Shutdown(object):
+    def __init__(self, role, deadline=60.0):
+        self.role = role
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.signum = None
+        self.callbacks = []
+
+    def install(self, signums=(signal.SIGTERM, signal.SIGINT, signal.SIGHUP)):
+        for signum in signums:
+            signal.signal(signum, self.handle)
+        return self
+
+    def handle(self, signum, frame):
+        if self.event.is_set():
+            print('[shutdown] {} received signal {} again, exiting now'.format(self.role, signum))
+            os._exit(128 + signum)
+        print('[shutdown] {} received signal {}, stopping within {:.0f}s'.format(self.role, signum, self.deadline))
+        self.signum = signum
+        self.event.set()
+
+        watchdog = threading.Thread(target=self.watchdog)
+        watchdog.daemon = True
+        watchdog.start()
+
+    def watchdog(self):
+        time.sleep(self.deadline)
+        print('[shutdown] {} did not stop within {:.0f}s, exiting'.format(self.role, self.deadline))
+        sys.stdout.flush()
+        os._exit(128 + self.signum)
+
+    def requested(self):
+        return self.event.is_set()
+
+    def wait(self, timeout):
+        '''sleep for timeout seconds, or until the stop is requested'''
+        return self.event.wait(timeout)
+
+    def on_stop(self, callback):
+        self.callbacks.append(callback)
+
+    def flush(self):
+        """run every callback, a failing one does not keep the others from running"""
+        for callback in self.callbacks:
+            start = time.time()
+            try:
+                callback()
+            except Exception:
+                print('[shutdown] {} failed to run {}:'.format(self.role, getattr(callback, '__name__', callback)))
+                traceback.print_exc()
+            print('[shutdown] {} ran {} in {:.1f}s'.format(self.role, getattr(callback, '__name__', callback), time.time() - start))
+        sys.stdout.flush()
+
+    def exit(self):
+        """
+        exit once flushed, without waiting for the threads of the role,
+        which are not all daemon threads and never end by themselves
+        """
+        print('[shutdown] {} stopped'.format(self.role))
+        sys.stdout.flush()
+        os._exit(0)
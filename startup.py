@@ -0,0 +1,35 @@
+"""
+Startup timing for the roles of a run (ps, worker, gan and the offline tools).
+
+Import this module first in an entry point, call mark() after each phase of
+the startup (parsing arguments, importing frameworks, building models, ...)
+and report() once the role is ready to do real work. The report is printed
+and appended to <logdir>/startup.txt, so the startup cost of every role of a
+run can be compared in one place.
+"""
+from __future__ import print_function
+import os
+import time
+
+_start_time = time.time()
+_last_time = _start_time
+_phases = []
+
+def mark(phase):
+    """record the time spent since the previous mark as phase"""
+    global _last_time
+    now = time.time()
+    _phases.append((phase, now - _last_time))
+    _last_time = now
+
+def report(role, logdir=None):
+    total = time.time() - _start_time
+    phases = ' '.join('%s=%.2fs' % (phase, seconds) for phase, seconds in _phases)
+    line = 'startup role=%s pid=%d total=%.2fs %s' % (role, os.getpid(), total, phases)
+    print(line)
+    if logdir is not None:
+        try:
+            with open(os.path.join(logdir, 'startup.txt'), 'a') as f:
+                f.write(time.strftime('%Y-%m-%d %H:%M:%S') + ' ' + line + '\n')
+        except (IOError, OSError) as e:
+            print('Failed to write startup report: ' + str(e))
@@ -0,0 +1,63 @@
+import tensorflow as tf
+import threading
+import time
+
+class SummaryAggregator(threading.Thread):
+    """
+    Buffers summaries in memory and writes them to a summary writer from a
+    background thread every interval seconds, so that neither the env stepping
+    thread nor the learner ever writes or flushes the event file.
+
+    Scalars are reduced to their mean per tag over the window.  Whole summaries
+    (such as the merged model summaries) can not be reduced and are written as
+    they are, in the same flush.
+    """
+    def __init__(self, summary_writer, interval=10.0, step_fn=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.summary_writer = summary_writer
+        self.interval = interval
+        self.step_fn = step_fn
+        self.lock = threading.Lock()
+        self.scalars = {}
+        self.summaries = []
+        self.last_step = 0
+
+    def add_scalar(self, tag, value, step=None):
+        with self.lock:
+            total, count = self.scalars.get(tag, (0.0, 0))
+            self.scalars[tag] = (total + float(value), count + 1)
+            if step is not None:
+                self.last_step = max(self.last_step, step)
+
+    def add_scalars(self, values, step=None):
+        for tag, value in values.items():
+            self.add_scalar(tag, value, step)
+
+    def add_summary(self, summary, step):
+        with self.lock:
+            self.summaries.append((summary, step))
+            self.last_step = max(self.last_step, step)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def write(self):
+        with self.lock:
+            scalars, self.scalars = self.scalars, {}
+            summaries, self.summaries = self.summaries, []
+            step = self.last_step
+        if self.step_fn is not None:
+            step = max(step, self.step_fn())
+
+        if len(scalars) > 0:
+            summary = tf.Summary()
+            for tag, (total, count) in sorted(scalars.items()):
+                summary.value.add(tag=tag, simple_value=total / count)
+            self.summary_writer.add_summary(summary, step)
+        for summary, summary_step in summaries:
+            self.summary_writer.add_summary(summary, summary_step)
+        if len(scalars) > 0 or len(summaries) > 0:
+            self.summary_writer.flush()
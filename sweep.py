@@ -0,0 +1,188 @@
+"""
+Runs a grid of gan configurations on one machine, as many at once as the
+core and memory budget allow, and collects their results into one table.
+
+    python sweep.py --grid gan_nz=128,256 --grid gan_batchsize=32,64 \\
+        --set run_on=video --max-iters 2000 --cpus-per-run 4 --mem-per-run 6
+
+Every run is a run_gan_predict.py (or --script) with its own config overrides
+(see overrides.py) and experiment name, so it gets its own logdir, pinned to
+its own cores.  A run is only started when a slot of cores is free and the
+machine has mem-per-run GB available.  Each run writes result.json into its
+logdir; the table of all of them is printed and written to results.tsv.
+"""
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from six.moves import shlex_quote
+import config
+import cpu_plan
+import overrides
+
+parser = argparse.ArgumentParser(description="Run a grid of configurations")
+parser.add_argument('--grid', action='append', default=[], metavar='KEY=V1,V2,...',
+                    help="Values of a setting of config.py to sweep over, the grid is the product of all of them")
+parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                    help="Override a setting of config.py for every run")
+parser.add_argument('--script', default='run_gan_predict.py', help="Training script every run executes")
+parser.add_argument('--max-iters', type=int, default=1000, help="Iterations of every run")
+parser.add_argument('--name', default=None, help="Name of the sweep, from the current time by default")
+parser.add_argument('--cpus', default=None, help="Cores the sweep may use (e.g. 0-31), all by default")
+parser.add_argument('--cpus-per-run', type=int, default=4, help="Cores of every run")
+parser.add_argument('--mem-per-run', type=float, default=4.0, help="GB of memory every run needs to be started")
+parser.add_argument('--out', default=None, help="Directory of the logs and the table of the sweep, under the logdir by default")
+parser.add_argument('-n', '--dry-run', action='store_true', help="Print the runs rather than executing them")
+
+def available_memory_gb():
+    '''MemAvailable of /proc/meminfo, None where it does not exist'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / (1024.0 * 1024.0)
+    except IOError:
+        pass
+    return None
+
+def grid(pairs):
+    """['gan_nz=128,256', 'gan_dct=4'] -> [{'gan_nz': 128, 'gan_dct': 4}, {'gan_nz': 256, 'gan_dct': 4}]"""
+    keys, values = [], []
+    for pair in pairs:
+        key, text = pair.split('=', 1)
+        keys.append(key)
+        values.append([overrides.parse_value(value) for value in text.split(',')])
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+class Run(object):
+    def __init__(self, index, sweep, settings):
+        self.index = index
+        self.settings = settings
+        self.experiment = '{}-{}'.format(sweep, index)
+        self.proc = None
+        self.slot = None
+        self.start_time = None
+        self.result = None
+
+    def logdir(self):
+        '''the logdir config.py derives for the settings of this run'''
+        return subprocess.check_output([sys.executable, '-c', 'import config; print(config.logdir)'],
+                                       env=self.env()).decode().strip()
+
+    def env(self):
+        env = dict(os.environ)
+        env[overrides.ENV_VAR] = json.dumps(self.settings, sort_keys=True)
+        env['GMBRL_EXPERIMENT'] = self.experiment
+        return env
+
+class Sweep(object):
+    """
+    Starts the runs in order, one per free slot of cores, and only while the
+    machine has the memory of one more run available
+    """
+    def __init__(self, runs, script, max_iters, slots, mem_per_run, outdir):
+        self.pending = list(runs)
+        self.running = []
+        self.done = []
+        self.script = script
+        self.max_iters = max_iters
+        self.free_slots = list(slots)
+        self.mem_per_run = mem_per_run
+        self.outdir = outdir
+
+    def command(self, run, cpus):
+        return [sys.executable, self.script, '--max-iters', str(self.max_iters),
+                '--cpus', cpu_plan.format_cpus(cpus), '--num-threads', str(len(cpus))]
+
+    def can_start(self):
+        if len(self.pending) == 0 or len(self.free_slots) == 0:
+            return False
+        memory = available_memory_gb()
+        return memory is None or memory >= self.mem_per_run
+
+    def start(self, run):
+        run.slot = self.free_slots.pop(0)
+        log = open(os.path.join(self.outdir, '{}.out'.format(run.experiment)), 'a')
+        run.proc = subprocess.Popen(self.command(run, run.slot), stdout=log, stderr=subprocess.STDOUT, env=run.env())
+        log.close()
+        run.start_time = time.time()
+        print('[sweep] started {} on cpus {}: {}'.format(run.experiment, cpu_plan.format_cpus(run.slot), json.dumps(run.settings, sort_keys=True)))
+
+    def finish(self, run):
+        self.free_slots.append(run.slot)
+        try:
+            with open(os.path.join(run.logdir(), 'result.json')) as f:
+                run.result = json.load(f)
+        except (IOError, ValueError, subprocess.CalledProcessError) as e:
+            print('[sweep] no result for {}: {}'.format(run.experiment, e))
+        print('[sweep] {} exited with {} after {:.0f}s'.format(run.experiment, run.proc.returncode, time.time() - run.start_time))
+        self.done.append(run)
+
+    def run(self, interval=5.0):
+        while len(self.pending) > 0 or len(self.running) > 0:
+            while self.can_start():
+                run = self.pending.pop(0)
+                self.start(run)
+                self.running.append(run)
+                '''let the run allocate its memory before checking for the next one'''
+                time.sleep(interval)
+            for run in list(self.running):
+                if run.proc.poll() is not None:
+                    self.running.remove(run)
+                    self.finish(run)
+            time.sleep(interval)
+
+def table(runs, keys):
+    """one row per run, the swept settings and the results"""
+    columns = ['run'] + keys + ['exit', 'iterations', 'iters_per_sec', 'loss_d', 'loss_g']
+    rows = [columns]
+    for run in sorted(runs, key=lambda run: run.index):
+        result = run.result or {}
+        rows.append([run.experiment] + [str(run.settings.get(key)) for key in keys] +
+                    [str(run.proc.returncode if run.proc is not None else None)] +
+                    [str(result.get(column)) for column in columns[len(keys) + 2:]])
+    return rows
+
+def main():
+    args = parser.parse_args()
+    name = args.name or 'sweep' + time.strftime('%m%d%H%M%S')
+    common = overrides.parse(args.set)
+    runs = []
+    for i, settings in enumerate(grid(args.grid)):
+        settings = dict(common, **settings)
+        runs.append(Run(i, name, settings))
+    keys = [pair.split('=', 1)[0] for pair in args.grid]
+
+    cpus = cpu_plan.parse_cpus(args.cpus) if args.cpus else cpu_plan.available_cpus()
+    slots = [cpus[i:i + args.cpus_per_run] for i in range(0, len(cpus) - args.cpus_per_run + 1, args.cpus_per_run)]
+    if len(slots) == 0:
+        slots = [cpus]
+    print('[sweep] {}: {} runs, {} at once on {} cores, {:.1f}GB each'.format(
+        name, len(runs), len(slots), len(cpus), args.mem_per_run))
+
+    outdir = args.out or os.path.join(config.logdir, 'sweeps', name)
+    sweep = Sweep(runs, args.script, args.max_iters, slots, args.mem_per_run, outdir)
+    if args.dry_run:
+        for run, slot in zip(runs, itertools.cycle(slots)):
+            print('{}={} GMBRL_EXPERIMENT={} {}'.format(overrides.ENV_VAR, shlex_quote(json.dumps(run.settings, sort_keys=True)),
+                                                       run.experiment, ' '.join(sweep.command(run, slot))))
+        return
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    sweep.run()
+
+    rows = table(sweep.done, keys)
+    with open(os.path.join(outdir, 'results.tsv'), 'w') as f:
+        f.write('\n'.join('\t'.join(row) for row in rows) + '\n')
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+    print('[sweep] results written to ' + os.path.join(outdir, 'results.tsv'))
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,55 @@
 import argparse
+import json
 import os
 import sys
-from six.moves import shlex_quote
+from six.moves import shlex_quote, reload_module
+import overrides
+overrides.from_argv()
 import config
+import cpu_plan
+import registry
 import subprocess
+import signal
+import time
 
 parser = argparse.ArgumentParser(description="Run commands")
 parser.add_argument('-w', '--num-workers', default=1, type=int,
                     help="Number of workers")
 parser.add_argument('-r', '--remotes', default=None,
                     help='The address of pre-existing VNC servers and '
-                         'rewarders to use (e.g. -r vnc://localhost:5900+15900,vnc://localhost:5901+15901).')
+                         'rewarders to use (e.g. -r vnc://localhost:5900+15900,vnc://localhost:5901+15901), '
+                         'one for every environment of every worker.')
 parser.add_argument('-e', '--env-id', type=str, default="PongDeterministic-v3",
                     help="Environment id")
-parser.add_argument('-l', '--log-dir', type=str, default=config.logdir,
-                    help="Log directory path")
+parser.add_argument('-l', '--log-dir', type=str, default=None,
+                    help="Log directory path, the logdir of the experiment in config.py by default")
+parser.add_argument('-x', '--experiment', type=str, default='',
+                    help="Name of the experiment, jobs with different names get their own session, "
+                         "logdir and ports and can run on the same machine")
+parser.add_argument('--num-envs', default=1, type=int,
+                    help="Number of environments each worker steps concurrently and acts in as a batch")
+parser.add_argument('--numpy-act', action='store_true',
+                    help="Let workers act with a numpy mirror of the policy instead of a session call")
+parser.add_argument('--sync-every', default=1, type=int,
+                    help="Workers pull weights from the parameter server every this many updates")
+parser.add_argument('--max-staleness', default=None, type=int,
+                    help="Workers also pull weights once the global step moved this many steps past their last pull")
+parser.add_argument('--backend', type=str, default='ps', choices=['ps', 'hogwild'],
+                    help="ps: share parameters through a parameter server task. hogwild: share them in memory on this node")
+parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                    help="Override a setting of config.py for every role (e.g. --set gan_nz=128), "
+                         "taken out of the arguments by overrides.from_argv() before they are parsed")
+parser.add_argument('--cpus', type=str, default=None,
+                    help="Cores to plan the roles on (e.g. 0-7,16-23), all the cores this process may use by default")
+parser.add_argument('--gan-cpus', type=int, default=None,
+                    help="Number of cores for the gan trainer, a quarter of the cores by default")
+parser.add_argument('--pin', action='store_true',
+                    help="Pin every role to its own cores and size its thread pools to them (see --cpus, --gan-cpus)")
 parser.add_argument('-n', '--dry-run', action='store_true',
                     help="Print out commands rather than executing them")
 parser.add_argument('-m', '--mode', type=str, default='tmux',
-                    help="tmux: run workers in a tmux session. nohup: run workers with nohup. child: run workers as child processes")
+                    help="tmux: run workers in a tmux session. nohup: run workers with nohup. child: run workers as child processes. "
+                         "supervise: run workers as child processes of this one, which restarts them when they exit")
 
 # Add visualise tag
 parser.add_argument('--visualise', action='store_true',
@@ -36,7 +67,33 @@ def new_cmd(session, name, cmd, mode, logdir, shell):
         return name, "nohup {} -c {} >{}/{}.{}.out 2>&1 & echo kill $! >>{}/kill.sh".format(shell, shlex_quote(cmd), logdir, session, name, logdir)
 
 
-def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash', mode='tmux', visualise=False):
+def worker_flags(args):
+    """extra worker.py flags for the acting and syncing options"""
+    flags = []
+    if args.num_envs > 1:
+        flags += ['--num-envs', str(args.num_envs)]
+    if args.numpy_act:
+        flags += ['--numpy-act']
+    if args.sync_every > 1:
+        flags += ['--sync-every', str(args.sync_every)]
+    if args.max_staleness is not None:
+        flags += ['--max-staleness', str(args.max_staleness)]
+    if args.backend != 'ps':
+        flags += ['--backend', args.backend]
+    return flags
+
+def plan_cpus(args):
+    """the cores of every role, None when roles are not pinned"""
+    if not args.pin:
+        return None
+    names = [name for name, _ in roles(args.num_workers, args.remotes, args.env_id, args.log_dir, backend=args.backend,
+                                              num_envs=args.num_envs)]
+    cpus = cpu_plan.parse_cpus(args.cpus) if args.cpus else None
+    return cpu_plan.plan(names, cpus, args.gan_cpus)
+
+def roles(num_workers, remotes, env_id, logdir, visualise=False, worker_args=(), backend='ps', cpu_budget=None,
+          base_port=None, tb_port=12345, experiment='', num_envs=1):
+    """the (name, command) of every process of a job"""
     # for launching the TF workers and for launching tensorboard
     base_cmd = [
         sys.executable, 'worker.py',
@@ -44,32 +101,72 @@ def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash',
         '--env-id', env_id,
         '--num-workers', str(num_workers)]
 
+    base_cmd += list(worker_args)
+
+    if base_port is not None:
+        base_cmd += ['--base-port', str(base_port)]
+
     if visualise:
         base_cmd += ['--visualise']
 
     if remotes is None:
         remotes = ["1"] * num_workers
     else:
+        '''every environment of every worker has its own remote, the envs of a worker get consecutive ones'''
         remotes = remotes.split(',')
-        assert len(remotes) == num_workers
+        if len(remotes) != num_workers * num_envs:
+            raise ValueError('{} workers with {} envs each need {} remotes, got {}'.format(
+                num_workers, num_envs, num_workers * num_envs, len(remotes)))
+        remotes = [','.join(remotes[i * num_envs:(i + 1) * num_envs]) for i in range(num_workers)]
 
-    cmds_map = [new_cmd(session, "ps", base_cmd + ["--job-name", "ps"], mode, logdir, shell)]
+    roles = []
+    if backend == 'ps':
+        roles += [("ps", base_cmd + ["--job-name", "ps"])]
     for i in range(num_workers):
-        cmds_map += [new_cmd(session,
-            "w-%d" % i, base_cmd + ["--job-name", "worker", "--task", str(i), "--remotes", remotes[i]], mode, logdir, shell)]
+        roles += [("w-%d" % i, base_cmd + ["--job-name", "worker", "--task", str(i), "--remotes", remotes[i]])]
 
     '''cmd for worker that trains gan'''
-    cmds_map += [new_cmd(session, "gan", [sys.executable, 'worker_train_gan.py'], mode, logdir, shell)]
+    roles += [("gan", [sys.executable, 'worker_train_gan.py'])]
+
+    roles += [("tb", [str(sys.executable).split('python')[0]+"tensorboard", "--logdir", logdir, "--port", str(tb_port)])]
+
+    if cpu_budget is not None:
+        roles = [(name, cmd + ["--cpus", cpu_plan.format_cpus(cpu_budget[name]),
+                               "--num-threads", str(cpu_plan.threads(name, cpu_budget[name]))])
+                 if name in cpu_budget else (name, cmd) for name, cmd in roles]
+
+    # config.py derives the logdir of every process from the experiment name, and reads the overrides
+    env = ["GMBRL_EXPERIMENT=" + experiment] if experiment else []
+    if overrides.env_assignment() is not None:
+        env += [overrides.env_assignment()]
+    if len(env) > 0:
+        roles = [(name, ["env"] + env + cmd) for name, cmd in roles]
+    return roles
+
+def recorded_command():
+    '''the command of this run, with the --set overrides that from_argv() took out of sys.argv'''
+    args = [sys.executable] + [arg for arg in sys.argv if arg != '-n']
+    for key, value in sorted(overrides.load().items()):
+        args += ['--set', '{}={}'.format(key, json.dumps(value))]
+    return [shlex_quote(arg) for arg in args]
 
-    cmds_map += [new_cmd(session, "tb", [str(sys.executable).split('python')[0]+"tensorboard", "--logdir", logdir, "--port", "12345"], mode, logdir, shell)]
+def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash', mode='tmux', visualise=False, worker_args=(), backend='ps', cpu_budget=None,
+                    base_port=None, tb_port=12345, experiment='', num_envs=1):
+    cmds_map = [new_cmd(session, name, cmd, mode, logdir, shell)
+                for name, cmd in roles(num_workers, remotes, env_id, logdir, visualise, worker_args, backend, cpu_budget,
+                                       base_port, tb_port, experiment, num_envs)]
 
     windows = [v[0] for v in cmds_map]
 
     notes = []
     cmds = [
         "mkdir -p {}".format(logdir),
-        "echo {} {} > {}/cmd.sh".format(sys.executable, ' '.join([shlex_quote(arg) for arg in sys.argv if arg != '-n']), logdir),
+        "echo {} > {}/cmd.sh".format(shlex_quote(' '.join(recorded_command())), logdir),
     ]
+    if backend == 'hogwild':
+        # a new run starts from fresh shared parameters, restored from the checkpoint if there is one
+        from hogwild import default_path
+        cmds += ["rm -f {}".format(shlex_quote(default_path(logdir)))]
     if mode == 'nohup' or mode == 'child':
         cmds += ["echo '#!/bin/sh' >{}/kill.sh".format(logdir)]
         notes += ["Run `source {}/kill.sh` to kill the job".format(logdir)]
@@ -78,12 +175,12 @@ def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash',
         notes += ["Use `tmux kill-session -t {}` to kill the job".format(session)]
     else:
         notes += ["Use `tail -f {}/*.out` to watch process output".format(logdir)]
-    notes += ["Point your browser to http://localhost:12345 to see Tensorboard"]
+    notes += ["Run `python kill.py{}` to kill the job and unregister it".format(" " + experiment if experiment else "")]
+    notes += ["Point your browser to http://localhost:{} to see Tensorboard".format(tb_port)]
 
     if mode == 'tmux':
+        # the ports were allocated free, only a previous run of the same experiment is killed
         cmds += [
-        "kill $( lsof -i:12345 -t ) > /dev/null 2>&1",  # kill any process using tensorboard's port
-        "kill $( lsof -i:12222-{} -t ) > /dev/null 2>&1".format(num_workers+12222), # kill any processes using ps / worker ports
         "tmux kill-session -t {}".format(session),
         "tmux new-session -s {} -n {} -d {}".format(session, windows[0], shell)
         ]
@@ -95,16 +192,190 @@ def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash',
 
     return cmds, notes
 
+class Supervisor(object):
+    """
+    Runs the roles of a job as child processes of this one and keeps them running.
+
+    The output of every role is appended to <logdir>/<session>.<name>.out.  A role
+    that exits is started again after a backoff, which doubles every time the role
+    exits again and is reset once it stayed up for stable_secs.  SIGINT and
+    SIGTERM stop the job: every role gets SIGTERM, and is killed if it is still
+    running stop_timeout seconds later, which leaves the roles the time to flush
+    their buffers and checkpoints (see shutdown.py).
+    """
+    def __init__(self, session, roles, logdir, min_backoff=1.0, max_backoff=60.0, stable_secs=60.0, stop_timeout=75.0):
+        self.session = session
+        self.names = [name for name, _ in roles]
+        self.cmds = dict(roles)
+        self.logdir = logdir
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_secs = stable_secs
+        self.stop_timeout = stop_timeout
+
+        self.procs = {}
+        self.start_times = {}
+        self.restart_times = {}
+        self.backoffs = dict((name, min_backoff) for name in self.names)
+        self.restarts = dict((name, 0) for name in self.names)
+        self.stopping = False
+
+    def log_path(self, name):
+        return os.path.join(self.logdir, "{}.{}.out".format(self.session, name))
+
+    def spawn(self, name):
+        cmd = self.cmds[name]
+        log = open(self.log_path(name), 'a')
+        log.write("==== {} starting: {}\n".format(time.strftime('%Y-%m-%d %H:%M:%S'), " ".join(shlex_quote(str(v)) for v in cmd)))
+        log.flush()
+        # each role gets its own process group, so that stopping it also stops its children
+        self.procs[name] = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        log.close()
+        self.start_times[name] = time.time()
+
+    def poll(self):
+        now = time.time()
+        for name in self.names:
+            proc = self.procs.get(name)
+            if proc is not None and proc.poll() is not None:
+                if now - self.start_times[name] >= self.stable_secs:
+                    self.backoffs[name] = self.min_backoff
+                delay = self.backoffs[name]
+                self.backoffs[name] = min(2 * delay, self.max_backoff)
+                self.restarts[name] += 1
+                print("[supervisor] {} exited with {} after {:.0f}s, restart {} in {:.0f}s".format(
+                    name, proc.returncode, now - self.start_times[name], self.restarts[name], delay))
+                self.procs[name] = None
+                self.restart_times[name] = now + delay
+            elif proc is None and now >= self.restart_times[name]:
+                self.spawn(name)
+
+    def handle_signal(self, signum, frame):
+        print("[supervisor] received signal {}, stopping".format(signum))
+        self.stopping = True
+
+    def run(self, interval=1.0):
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGHUP, self.handle_signal)
+        for name in self.names:
+            self.spawn(name)
+        while not self.stopping:
+            time.sleep(interval)
+            self.poll()
+        self.stop()
+
+    def send(self, proc, signum):
+        try:
+            os.killpg(proc.pid, signum)
+        except OSError:
+            pass
+
+    def stop(self):
+        running = [(name, proc) for name, proc in self.procs.items() if proc is not None and proc.poll() is None]
+        for name, proc in running:
+            self.send(proc, signal.SIGTERM)
+        deadline = time.time() + self.stop_timeout
+        while time.time() < deadline and any(proc.poll() is None for _, proc in running):
+            time.sleep(0.2)
+        for name, proc in running:
+            if proc.poll() is None:
+                print("[supervisor] {} did not stop in {:.0f}s, killing it".format(name, self.stop_timeout))
+                self.send(proc, signal.SIGKILL)
+                proc.wait()
+        print("[supervisor] all roles stopped")
+
+def allocate_ports(args, session, mode):
+    """
+    allocate free ports for the ps, the workers and tensorboard, and unless this is
+    a dry run, register the job so that kill.py and other jobs know about it.
+    Hogwild workers share memory instead of ports, only tensorboard binds one
+    """
+    if args.backend == 'ps':
+        count = args.num_workers + 2
+    else:
+        count = 1
+    if args.dry_run:
+        '''show the ports the job would get, without locking or writing the registry'''
+        base_port = registry.allocate_ports(count, registry.load())
+        return base_port, base_port + count - 1
+    with registry.locked() as experiments:
+        base_port = registry.allocate_ports(count, experiments)
+        experiments[session] = {
+            'experiment': args.experiment,
+            'logdir': os.path.abspath(args.log_dir),
+            'mode': mode,
+            'backend': args.backend,
+            'pid': os.getpid(),
+            'ports': list(range(base_port, base_port + count)),
+            'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+    # tensorboard takes the last port of the range
+    return base_port, base_port + count - 1
+
 def prepare_dir():
     subprocess.call(["mkdir", "-p", config.logdir])
     subprocess.call(["mkdir", "-p", config.modeldir])
     subprocess.call(["mkdir", "-p", config.datadir])
 
+def print_cpu_plan(args):
+    budget = plan_cpus(args)
+    if budget is None:
+        print("Roles are not pinned to cores")
+    else:
+        print("Core budget of the roles:")
+        print("\n".join(cpu_plan.describe(budget)))
+    print("")
+
+def supervise(args):
+    session = registry.session_name(args.experiment)
+    base_port, tb_port = allocate_ports(args, session, 'supervise')
+    job_roles = roles(args.num_workers, args.remotes, args.env_id, args.log_dir, visualise=args.visualise,
+                      worker_args=worker_flags(args), backend=args.backend, cpu_budget=plan_cpus(args),
+                      base_port=base_port, tb_port=tb_port, experiment=args.experiment, num_envs=args.num_envs)
+    supervisor = Supervisor(session, job_roles, args.log_dir)
+    if args.dry_run:
+        print_cpu_plan(args)
+        print("Dry-run mode due to -n flag, otherwise the following roles would be supervised:")
+    else:
+        print("Supervising the following roles:")
+    for name, cmd in job_roles:
+        print("{}: {}".format(name, " ".join(shlex_quote(str(v)) for v in cmd)))
+    print("")
+    print("Use `tail -f {}/*.out` to watch process output".format(args.log_dir))
+    print("Point your browser to http://localhost:{} to see Tensorboard".format(tb_port))
+    print("Press Ctrl-C, send SIGTERM to {} or run `python kill.py{}` to stop the job".format(
+        os.getpid(), " " + args.experiment if args.experiment else ""))
+    if not args.dry_run:
+        subprocess.call(["mkdir", "-p", args.log_dir])
+        if args.backend == 'hogwild':
+            from hogwild import default_path
+            subprocess.call(["rm", "-f", default_path(args.log_dir)])
+        supervisor.run()
+        if args.backend == 'hogwild':
+            '''the shared parameters are in /dev/shm, which is memory'''
+            subprocess.call(["rm", "-f", default_path(args.log_dir)])
+        with registry.locked() as experiments:
+            experiments.pop(session, None)
+
 def run():
-    prepare_dir()
+    global config
     args = parser.parse_args()
-    cmds, notes = create_commands("a3c", args.num_workers, args.remotes, args.env_id, args.log_dir, mode=args.mode, visualise=args.visualise)
+    if args.experiment:
+        os.environ['GMBRL_EXPERIMENT'] = args.experiment
+        config = reload_module(config)
+    if args.log_dir is None:
+        args.log_dir = config.logdir
+    prepare_dir()
+    if args.mode == 'supervise':
+        supervise(args)
+        return
+    session = registry.session_name(args.experiment)
+    base_port, tb_port = allocate_ports(args, session, args.mode)
+    cmds, notes = create_commands(session, args.num_workers, args.remotes, args.env_id, args.log_dir, mode=args.mode, visualise=args.visualise, worker_args=worker_flags(args), backend=args.backend, cpu_budget=plan_cpus(args),
+                                  base_port=base_port, tb_port=tb_port, experiment=args.experiment, num_envs=args.num_envs)
     if args.dry_run:
+        print_cpu_plan(args)
         print("Dry-run mode due to -n flag, otherwise the following commands would be executed:")
     else:
         print("Executing the following commands:")
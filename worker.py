@@ -1,29 +1,42 @@
-from a3c import A3C
-import cv2
-import go_vncdriver
-import tensorflow as tf
+import startup
+import overrides
+overrides.from_argv()
+import profiler
+import shutdown
 import argparse
 import logging
 import sys, signal
 import time
 import os
-from envs import create_env
 import distutils.version
-use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('0.12.0')
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Disables write_meta_graph argument, which freezes entire process and is mostly useless.
-class FastSaver(tf.train.Saver):
-    def save(self, sess, save_path, global_step=None, latest_filename=None,
-             meta_graph_suffix="meta", write_meta_graph=True):
-        super(FastSaver, self).save(sess, save_path, global_step, latest_filename,
-                                    meta_graph_suffix, False)
+def run(args, server, stopper):
+    import tensorflow as tf
+    import metrics
+    from a3c import A3C
+    from envs import create_env
+    use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('0.12.0')
+    startup.mark('import_a3c')
 
-def run(args, server):
-    env = create_env(args.env_id, client_id=str(args.task), remotes=args.remotes)
-    trainer = A3C(env, args.task, args.visualise)
+    # Disables write_meta_graph argument, which freezes entire process and is mostly useless.
+    class FastSaver(tf.train.Saver):
+        def save(self, sess, save_path, global_step=None, latest_filename=None,
+                 meta_graph_suffix="meta", write_meta_graph=True):
+            super(FastSaver, self).save(sess, save_path, global_step, latest_filename,
+                                        meta_graph_suffix, False)
+
+    env = create_env(args.env_id, client_id=str(args.task), remotes=args.remotes, num_envs=args.num_envs,
+                     record=args.record_env, replay_fps=args.replay_fps)
+    startup.mark('create_env')
+    hogwild = args.backend == 'hogwild'
+    trainer = A3C(env, args.task, args.visualise, numpy_act=args.numpy_act,
+                  sync_every=args.sync_every, max_staleness=args.max_staleness,
+                  backend=args.backend, shared_path=hogwild_path(args) if hogwild else None,
+                  num_threads=args.num_threads)
+    startup.mark('build_graph')
 
     # Variable names that start with "local" are not saved in checkpoints.
     if use_tf12_api:
@@ -45,7 +58,10 @@ def run(args, server):
         logger.info("Initializing all parameters.")
         ses.run(init_all_op)
 
-    config = tf.ConfigProto(device_filters=["/job:ps", "/job:worker/task:{}".format(args.task)])
+    if hogwild:
+        config = tf.ConfigProto(**session_threads(args))
+    else:
+        config = tf.ConfigProto(device_filters=["/job:ps", "/job:worker/task:{}".format(args.task)])
     config.gpu_options.allow_growth=True
     logdir = os.path.join(args.log_dir, 'train')
 
@@ -55,8 +71,10 @@ def run(args, server):
         summary_writer = tf.train.SummaryWriter(logdir + "_%d" % args.task)
 
     logger.info("Events directory: %s_%s", logdir, args.task)
-    sv = tf.train.Supervisor(is_chief=(args.task == 0),
-                             logdir=logdir,
+    # with the hogwild backend every worker initializes its own graph,
+    # and only the first one saves checkpoints
+    sv = tf.train.Supervisor(is_chief=(args.task == 0 or hogwild),
+                             logdir=logdir if args.task == 0 or not hogwild else None,
                              saver=saver,
                              summary_op=None,
                              init_op=init_op,
@@ -69,28 +87,62 @@ def run(args, server):
 
     num_global_steps = 100000000
 
+    # the chief writes the checkpoint file on every save
+    metrics.gauge('checkpoint_age_seconds', 'seconds since the last checkpoint of the policy').set_function(
+        lambda: time.time() - os.path.getmtime(os.path.join(logdir, 'checkpoint')))
+    metrics.start('w-%d' % args.task, args.log_dir, port=args.metrics_port)
+
     logger.info(
         "Starting session. If this hangs, we're mostly likely waiting to connect to the parameter server. " +
         "One common cause is that the parameter server DNS name isn't resolving yet, or is misspecified.")
-    with sv.managed_session(server.target, config=config) as sess, sess.as_default():
-        sess.run(trainer.sync)
+    with sv.managed_session(server.target if server is not None else '', config=config) as sess, sess.as_default():
+        if hogwild:
+            trainer.connect_shared(sess)
+        trainer.pull_weights(sess)
         trainer.start(sess, summary_writer)
         global_step = sess.run(trainer.global_step)
+        startup.mark('start_session')
+        startup.report('worker', args.log_dir)
         logger.info("Starting training at step=%d", global_step)
-        while not sv.should_stop() and (not num_global_steps or global_step < num_global_steps):
-            trainer.process(sess)
+
+        # on a stop request, hand off the collected transitions and write a last checkpoint
+        stopper.on_stop(trainer.flush)
+        if args.task == 0:
+            def save_checkpoint():
+                if hogwild:
+                    '''the global network holds the last pulled copy of the shared parameters'''
+                    trainer.pull_weights(sess)
+                saver.save(sess, sv.save_path, global_step=trainer.global_step)
+            stopper.on_stop(save_checkpoint)
+
+        while not sv.should_stop() and not stopper.requested() and (not num_global_steps or global_step < num_global_steps):
+            trainer.process(sess, should_stop=stopper.requested)
             global_step = sess.run(trainer.global_step)
 
+        if stopper.requested():
+            stopper.flush()
+            stopper.exit()
+
     # Ask for all the services to stop.
     sv.stop()
     logger.info('reached %s steps. worker stopped.', global_step)
 
-def cluster_spec(num_workers, num_ps):
+def session_threads(args):
+    '''thread pools of a session, the whole --num-threads budget goes to the ops'''
+    if args.num_threads is None:
+        return dict(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2)
+    return dict(intra_op_parallelism_threads=args.num_threads, inter_op_parallelism_threads=min(2, args.num_threads))
+
+def hogwild_path(args):
+    from hogwild import default_path
+    return args.shared_path or default_path(args.log_dir)
+
+def cluster_spec(num_workers, num_ps, base_port=4132):
     """
 More tensorflow setup for data parallelism
 """
     cluster = {}
-    port = 4132
+    port = base_port
 
     all_ps = []
     host = '127.0.0.1'
@@ -118,39 +170,95 @@ Setting up Tensorflow for data parallel work
     parser.add_argument('--num-workers', default=1, type=int, help='Number of workers')
     parser.add_argument('--log-dir', default="/tmp/pong", help='Log directory path')
     parser.add_argument('--env-id', default="PongDeterministic-v3", help='Environment id')
+    parser.add_argument('--num-envs', default=1, type=int, help='Number of environments each worker steps concurrently and acts in as a batch')
     parser.add_argument('-r', '--remotes', default=None,
                         help='References to environments to create (e.g. -r 20), '
                              'or the address of pre-existing VNC servers and '
-                             'rewarders to use (e.g. -r vnc://localhost:5900+15900,vnc://localhost:5901+15901)')
+                             'rewarders to use (e.g. -r vnc://localhost:5900+15900,vnc://localhost:5901+15901), '
+                             'one address for each of the --num-envs environments')
+
+    parser.add_argument('--numpy-act', action='store_true',
+                        help='Act with a numpy mirror of the local network instead of a session call')
+
+    parser.add_argument('--sync-every', default=1, type=int,
+                        help='Pull weights from the parameter server every this many updates')
+    parser.add_argument('--max-staleness', default=None, type=int,
+                        help='Also pull weights once the global step moved this many steps past the last pull')
+
+    parser.add_argument('--base-port', default=4132, type=int,
+                        help='First port of the ps and worker tasks, train.py allocates a free range per experiment')
+    parser.add_argument('--metrics-port', default=None, type=int,
+                        help='Also serve the metrics of this worker over http on this port')
+    parser.add_argument('--backend', default='ps', choices=['ps', 'hogwild'],
+                        help='ps: share parameters through a tensorflow parameter server. '
+                             'hogwild: single node, share them in memory and update them without locks')
+    parser.add_argument('--shared-path', default=None,
+                        help='File holding the shared parameters of the hogwild backend (default: in /dev/shm)')
+
+    parser.add_argument('--cpus', default=None,
+                        help='Pin this process to these cores (e.g. 0-3), as planned by train.py')
+    parser.add_argument('--num-threads', default=None, type=int,
+                        help='Size of the tensorflow and torch thread pools, the number of --cpus by default')
+
+    parser.add_argument('--record-env', default=None,
+                        help='Record the observations, rewards and dones of the environments under this directory, '
+                             'to replay them with --env-id replay:<dir>')
+    parser.add_argument('--replay-fps', default=None, type=float,
+                        help='Steps per second of a replayed environment, as fast as possible by default')
 
     # Add visualisation argument
     parser.add_argument('--visualise', action='store_true',
                         help="Visualise the gym environment by running env.render() between each timestep")
 
     args = parser.parse_args()
-    spec = cluster_spec(args.num_workers, 1)
-    cluster = tf.train.ClusterSpec(spec).as_cluster_def()
 
-    def shutdown(signal, frame):
-        logger.warn('Received signal %s: exiting', signal)
-        sys.exit(128+signal)
-    signal.signal(signal.SIGHUP, shutdown)
-    signal.signal(signal.SIGINT, shutdown)
-    signal.signal(signal.SIGTERM, shutdown)
+    # pin before the frameworks are imported, so that their thread pools are sized for our cores
+    if args.cpus is not None:
+        import cpu_plan
+        args.num_threads = cpu_plan.apply(cpu_plan.parse_cpus(args.cpus), args.num_threads)
 
+    # Only the worker role talks to VNC environments. go_vncdriver has to be
+    # imported before tensorflow, so tensorflow is imported here, per role.
     if args.job_name == "worker":
-        config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2)
+        import go_vncdriver
+    import tensorflow as tf
+    startup.mark('import_tf')
+
+    if args.backend != 'hogwild':
+        spec = cluster_spec(args.num_workers, 1, args.base_port)
+        cluster = tf.train.ClusterSpec(spec).as_cluster_def()
+
+    # kill -USR1 profiles this process for a while
+    role = 'ps' if args.job_name == 'ps' else 'w-%d' % args.task
+    profiler.install(args.log_dir, role)
+
+    # SIGTERM, SIGINT and SIGHUP request a stop, that flushes before exiting
+    stopper = shutdown.Shutdown(role).install()
+
+    if args.backend == 'hogwild':
+        '''no ps task and no servers, the workers share their parameters in memory'''
+        assert args.job_name == "worker", "the hogwild backend has no ps task"
+        run(args, None, stopper)
+    elif args.job_name == "worker":
+        config = tf.ConfigProto(**session_threads(args))
         config.gpu_options.allow_growth=True
         server = tf.train.Server(cluster, job_name="worker", task_index=args.task,
                                  config=config)
-        run(args, server)
+        run(args, server, stopper)
     else:
         config = tf.ConfigProto(device_filters=["/job:ps"])
+        if args.num_threads is not None:
+            '''without a budget from train.py, the ps keeps the default pools of tensorflow'''
+            config.intra_op_parallelism_threads = args.num_threads
+            config.inter_op_parallelism_threads = min(2, args.num_threads)
         config.gpu_options.allow_growth=True
         server = tf.train.Server(cluster, job_name="ps", task_index=args.task,
                                  config=config)
-        while True:
-            time.sleep(1000)
+        startup.mark('start_server')
+        startup.report('ps', args.log_dir)
+        while not stopper.wait(1000):
+            pass
+        stopper.exit()
 
 if __name__ == "__main__":
-    tf.app.run()
+    main(sys.argv)
@@ -1,38 +1,21 @@
 from __future__ import print_function
-import torch
-import torch.nn as nn
-import torch.nn.parallel
-import torch.backends.cudnn as cudnn
-import torch.optim as optim
-import torch.utils.data
-import torchvision.datasets as dset
-import torchvision.transforms as transforms
-import torchvision.utils as vutils
-from torch.autograd import Variable
-from collections import namedtuple
-import numpy as np
-import go_vncdriver
-import tensorflow as tf
-from model import LSTMPolicy
-import six.moves.queue as queue
-import scipy.signal
-import threading
-import distutils.version
-import config
-import globalvar as GlobalVar
+import startup
+import overrides
+overrides.from_argv()
 import argparse
-import random
+import cpu_plan
+import profiler
+import shutdown
+import metrics
 import os
-import copy
-import wgan_models.dcgan as dcgan
-import wgan_models.mlp as mlp
-import support_lib
+import numpy as np
 import config
-import subprocess
 import time
-import multiprocessing
 import gan
-use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('0.12.0')
+import torch
+
+transitions_received = metrics.counter('transitions_received_total', 'transitions loaded from the data the workers handed off')
+data_handoff_latency = metrics.summary('data_handoff_latency_seconds', 'age of the data handed off by the workers when it is loaded')
 
 class GanTrainer():
     """
@@ -41,6 +24,7 @@ class GanTrainer():
     def __init__(self):
         
         self.gan = gan.gan() # create gan
+        self.gan.load_dataset() # resume from the transitions saved on the last shutdown
         self.last_load_time = time.time() # record last_load_time as initialize time
 
     def load_data(self):
@@ -51,11 +35,14 @@ class GanTrainer():
             print('Try loading data...')
             data = None
             try:
+                data_age = time.time() - os.path.getmtime(config.datadir+'data.npz')
                 data = np.load(config.datadir+'data.npz')['data'] # load data
                 if np.shape(data)[0] is 0:
                     return
                 else:
                     print('Data loaded: '+str(np.shape(data)))
+                    transitions_received.inc(np.shape(data)[0])
+                    data_handoff_latency.observe(data_age)
                 self.last_load_time = time.time() # record last load time
                 np.savez(config.datadir+'data.npz',
                          data=self.gan.empty_dataset_with_aux)
@@ -66,15 +53,34 @@ class GanTrainer():
             if data is not None:
                 self.gan.push_data(data) # push data to gan
 
-    def run(self):
+    def run(self, stopper):
 
-        while True:
+        stopper.on_stop(self.gan.save_models)
+        stopper.on_stop(self.gan.save_dataset)
+        while not stopper.requested():
 
             '''keep running'''
             self.load_data()
             self.gan.train()
             time.sleep(config.lower_gan_worker)
+        stopper.flush()
+        stopper.exit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=None)
+    parser.add_argument('--cpus', default=None,
+                        help='Pin this process to these cores (e.g. 4-7), as planned by train.py')
+    parser.add_argument('--num-threads', default=None, type=int,
+                        help='Size of the torch thread pool, the number of --cpus by default')
+    parser.add_argument('--metrics-port', default=None, type=int,
+                        help='Also serve the metrics of the gan trainer over http on this port')
+    args = parser.parse_args()
+    if args.cpus is not None:
+        torch.set_num_threads(cpu_plan.apply(cpu_plan.parse_cpus(args.cpus), args.num_threads))
+    startup.mark('imports')
     trainer = GanTrainer()
-    trainer.run()
\ No newline at end of file
+    startup.mark('build_gan')
+    startup.report('gan', config.logdir)
+    metrics.start('gan', config.logdir, port=args.metrics_port)
+    profiler.install(config.logdir, 'gan')
+    trainer.run(shutdown.Shutdown('gan').install())
\ No newline at end of file